@@ -1,10 +1,14 @@
+import math
+
 import numpy as np
-from scipy.stats import norm
 
 import cv2
 from tqdm import tqdm
 from enum import IntEnum
 
+from pose_buffer import PoseBuffer
+import profiling
+
 class Joint(IntEnum):
     NOSE = 0
     NECK = 1
@@ -33,6 +37,167 @@ class Joint(IntEnum):
     RHEEL = 24
 
 
+# Scored joints, each given as (vertex, start, end) so the angle is measured at the vertex
+ANGLE_JOINTS = {
+    "lshoulder" : (Joint.LSHOULDER, Joint.NECK, Joint.LELBOW),
+    "rShoulder" : (Joint.RSHOULDER, Joint.NECK, Joint.RELBOW),
+    "lelbow" : (Joint.LELBOW, Joint.LSHOULDER, Joint.LWRIST),
+    "relbow" : (Joint.RELBOW, Joint.RSHOULDER, Joint.RWRIST),
+    "lhip" : (Joint.LHIP, Joint.NECK, Joint.LKNEE),
+    "rhip" : (Joint.RHIP, Joint.NECK, Joint.RKNEE),
+    "lknee" : (Joint.LKNEE, Joint.LHIP, Joint.LANKLE),
+    "rknee" : (Joint.RKNEE, Joint.RHIP, Joint.RANKLE),
+    "lankle" : (Joint.LANKLE, Joint.LKNEE, Joint.LBIGTOE),
+    "rankle" : (Joint.RANKLE, Joint.RKNEE, Joint.RBIGTOE)
+}
+
+
+class ScoredJoint(IntEnum):
+    """Index of every scored joint, in the order of ANGLE_JOINTS and named after its vertex in Joint."""
+    LSHOULDER = 0
+    RSHOULDER = 1
+    LELBOW = 2
+    RELBOW = 3
+    LHIP = 4
+    RHIP = 5
+    LKNEE = 6
+    RKNEE = 7
+    LANKLE = 8
+    RANKLE = 9
+
+    @property
+    def key(self):
+        """Name of the joint in ANGLE_JOINTS and in score dictionaries."""
+        return _SCORED_JOINT_KEYS[self]
+
+
+_SCORED_JOINT_KEYS = list(ANGLE_JOINTS)
+
+
+class Dancer(IntEnum):
+    STUDENT = 0
+    TEACHER = 1
+
+
+class Metric(IntEnum):
+    POSITION = 0
+    VELOCITY = 1
+
+
+# Keypoints with a confidence below this are treated as missing
+MIN_CONFIDENCE = 0.1
+
+
+# Pairs of keypoints joined by a limb when drawing a skeleton
+JOINT_CONNECTIONS = [
+    [Joint.NECK, Joint.NOSE],
+    [Joint.NECK, Joint.LSHOULDER],
+    [Joint.LSHOULDER, Joint.LELBOW],
+    [Joint.LELBOW, Joint.LWRIST],
+    [Joint.NECK, Joint.RSHOULDER],
+    [Joint.RSHOULDER, Joint.RELBOW],
+    [Joint.RELBOW, Joint.RWRIST],
+    [Joint.NECK, Joint.MIDHIP],
+    [Joint.MIDHIP, Joint.LHIP],
+    [Joint.LHIP, Joint.LKNEE],
+    [Joint.LKNEE, Joint.LANKLE],
+    [Joint.LANKLE, Joint.LBIGTOE],
+    [Joint.MIDHIP, Joint.RHIP],
+    [Joint.RHIP, Joint.RKNEE],
+    [Joint.RKNEE, Joint.RANKLE],
+    [Joint.RANKLE, Joint.RBIGTOE]
+]
+
+
+def draw_skeleton(image, pose, color, thickness = 9):
+    """Draws the limbs of the first person of a pose onto an image in place.
+
+    Args:
+        image: BGR image to draw on
+        pose: A (1, 25, 3) keypoint array
+        color: BGR line color
+        thickness: Line thickness in pixels
+
+    Returns:
+        The image that was drawn on
+    """
+    for start, end in JOINT_CONNECTIONS:
+        if(pose[0, start, 2] > MIN_CONFIDENCE and pose[0, end, 2] > MIN_CONFIDENCE):
+            start_point = tuple(pose[0, start, 0:2].astype(int))
+            end_point = tuple(pose[0, end, 0:2].astype(int))
+            image = cv2.line(image, start_point, end_point, color, thickness)
+    return image
+
+
+def stack_people(poses):
+    """Stacks a sequence of frame poses with every person into a single array.
+
+    Args:
+        poses: A PoseBuffer, a list of (P, 25, 3) keypoint arrays or an (N, P, 25, 3) array
+
+    Returns:
+        A float32 array of shape (N, P, 25, 3)
+    """
+    if isinstance(poses, PoseBuffer):
+        poses = poses.view()
+    poses = np.asarray(poses, dtype = np.float32)
+    if poses.size == 0:
+        return np.zeros(shape = (0, 1, 25, 3), dtype = np.float32)
+    return poses.reshape(poses.shape[0], -1, 25, 3)
+
+
+def stack_poses(poses):
+    """Stacks a sequence of frame poses into a single array.
+
+    Args:
+        poses: A PoseBuffer, a list of (1, 25, 3) keypoint arrays or an (N, 1, 25, 3) array
+
+    Returns:
+        A float32 array of shape (N, 25, 3) holding the first person of every frame
+    """
+    return stack_people(poses)[:, 0]
+
+
+def calc_joint_angles(poses):
+    """Calculates the angle of every scored joint for every frame at once.
+
+    Args:
+        poses: A float32 array of shape (N, 25, 3)
+
+    Returns:
+        A float32 array of shape (N, 10) indexed by ScoredJoint. Joints where any
+        of the three keypoints is below MIN_CONFIDENCE are set to -1.
+    """
+    points = poses[:, np.array([ANGLE_JOINTS[joint.key] for joint in ScoredJoint]), :]
+    vertex, start, end = points[:, :, 0], points[:, :, 1], points[:, :, 2]
+
+    # Calculate the two vectors that form each joint
+    v1 = start[..., 0:2] - vertex[..., 0:2]
+    v2 = end[..., 0:2] - vertex[..., 0:2]
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        cos = np.sum(v1*v2, axis = -1)/np.linalg.norm(v1, axis = -1)/np.linalg.norm(v2, axis = -1)
+        angles = np.arccos(np.clip(cos, -1., 1.))
+
+    valid = np.all(points[..., 2] >= MIN_CONFIDENCE, axis = -1)
+    return np.where(valid, angles, -1).astype(np.float32)
+
+
+def calc_joint_velocities(poses):
+    """Calculates the frame-to-frame displacement of every scored joint at once.
+
+    Args:
+        poses: A float32 array of shape (N, 25, 3)
+
+    Returns:
+        A float32 array of shape (N-1, 10) indexed by ScoredJoint. Joints that are
+        below MIN_CONFIDENCE in either frame are set to -1.
+    """
+    points = poses[:, np.array([ANGLE_JOINTS[joint.key][0] for joint in ScoredJoint]), :]
+    velocities = np.linalg.norm(points[1:, :, 0:2] - points[:-1, :, 0:2], axis = -1)
+    valid = (points[1:, :, 2] >= MIN_CONFIDENCE) & (points[:-1, :, 2] >= MIN_CONFIDENCE)
+    return np.where(valid, velocities, -1).astype(np.float32)
+
 
 class DanceScorer:
     # Range values for the min-max joint angles
@@ -49,72 +214,67 @@ class DanceScorer:
                 "rankle" : 2.271983564
             }
     SIGMA_SCALE = 12
+    # Scale score by 2.2 to make it less disheartening
+    # With the current scheme, the scores are very low, scale them up so they saturate the 0-100 spectrum better
+    AVERAGE_SCALE = 2.2
 
     def __init__(self):
 
-        # Instantiate two lists to store the teacher and student poses
+        # Instantiate two buffers to store the teacher and student poses
         self.poses = {
-            "student" : [],
-            "teacher" : []
+            "student" : PoseBuffer(),
+            "teacher" : PoseBuffer()
         }
 
+        # Precomputed teacher metrics, see use_reference
+        self.reference = None
+        self.reference_start = 0
 
-        # Each element in this dictionary is a list of length n storing the tracked metrics
-        self.position_metrics = {
-            "student" : {
-                "lshoulder" : [],
-                "rShoulder" : [],
-                "lelbow" : [],
-                "relbow" : [],
-                "lhip" : [],
-                "rhip" : [],
-                "lknee" : [],
-                "rknee" : [],
-                "lankle" : [],
-                "rankle" : []
-            },
-            "teacher" : {
-                "lshoulder" : [],
-                "rShoulder" : [],
-                "lelbow" : [],
-                "relbow" : [],
-                "lhip" : [],
-                "rhip" : [],
-                "lknee" : [],
-                "rknee" : [],
-                "lankle" : [],
-                "rankle" : []
-            }
-        }
 
-        # Each element in this dictionary is a list of length n-1
-        # These are all "first derviative" metrics like velocity
-        self.velocity_metrics = {
-            "student" : {
-                "lshoulder" : [],
-                "rShoulder" : [],
-                "lelbow" : [],
-                "relbow" : [],
-                "lhip" : [],
-                "rhip" : [],
-                "lknee" : [],
-                "rknee" : [],
-                "lankle" : [],
-                "rankle" : []
-            },
-            "teacher" : {
-                "lshoulder" : [],
-                "rShoulder" : [],
-                "lelbow" : [],
-                "relbow" : [],
-                "lhip" : [],
-                "rhip" : [],
-                "lknee" : [],
-                "rknee" : [],
-                "lankle" : [],
-                "rankle" : []
-            }
-        }
+        # Metrics of both dancers as (dancer, metric, joint, frame), indexed with Dancer, Metric and ScoredJoint.
+        # Velocities have one frame less than positions, entries past the end of a dancer are -1.
+        self.metrics = np.full(shape = (len(Dancer), len(Metric), len(ScoredJoint), 0), fill_value = -1, dtype = np.float32)
+        # Number of frames stored for each dancer
+        self.metric_lengths = [0]*len(Dancer)
+
+    @property
+    def position_metrics(self):
+        """Joint angles as {dancer: {joint: (n,) array}}, views into metrics."""
+        return self._metric_views(Metric.POSITION)
+
+    @property
+    def velocity_metrics(self):
+        """Joint velocities as {dancer: {joint: (n-1,) array}}, views into metrics."""
+        return self._metric_views(Metric.VELOCITY)
+
+    def _metric_views(self, metric):
+        views = {}
+        for dancer in Dancer:
+            length = self.metric_lengths[dancer]
+            if metric == Metric.VELOCITY:
+                length = max(length - 1, 0)
+            views[dancer.name.lower()] = {joint.key : self.metrics[dancer, metric, joint, :length] for joint in ScoredJoint}
+        return views
+
+    def _metric_rows(self, dancer, frames):
+        """Makes room for the metrics of a dancer.
+
+        Args:
+            dancer: "student" or "teacher"
+            frames: Number of frames of the dancer
+
+        Returns:
+            The (metric, joint, frame) slice of metrics belonging to the dancer, filled with -1
+        """
+        if frames > self.metrics.shape[-1]:
+            grown = np.full(shape = self.metrics.shape[:-1] + (frames,), fill_value = -1, dtype = np.float32)
+            grown[..., :self.metrics.shape[-1]] = self.metrics
+            self.metrics = grown
+        index = Dancer[dancer.upper()]
+        self.metric_lengths[index] = frames
+        rows = self.metrics[index]
+        rows.fill(-1)
+        return rows
 
     def _calc_angle(self, joint, start_joint, end_joint):
 
@@ -169,10 +329,54 @@ class DanceScorer:
         if(dancer != "student" and dancer != "teacher"):
             raise Exception("Selected dancer must be a student or teacher")
 
-        # Create numpy arrays of the right length
-        for joint in self.position_metrics[dancer]:
-            self.position_metrics[dancer][joint] = np.zeros(shape = (len(self.poses[dancer]), ), dtype = np.float32)
-            self.velocity_metrics[dancer][joint] = np.zeros(shape = (len(self.poses[dancer])-1, ), dtype = np.float32)
+        if dancer == "teacher" and self._reference_metrics():
+            return
+
+        poses = stack_poses(self.poses[dancer])
+
+        # Metrics are computed as (frames, joints) and stored as one contiguous row per joint
+        rows = self._metric_rows(dancer, len(poses))
+        rows[Metric.POSITION, :, :len(poses)] = calc_joint_angles(poses).T
+        rows[Metric.VELOCITY, :, :len(poses) - 1] = calc_joint_velocities(poses).T
+
+    def use_reference(self, reference, start=0):
+        """Takes the teacher metrics from a TeacherReference instead of computing them.
+
+        Args:
+            reference: TeacherReference of the teacher video
+            start: Frame of the reference matching the first teacher pose, e.g. its alignment offset
+        """
+        self.reference = reference
+        self.reference_start = start
+
+    def _reference_metrics(self):
+        """Fills the teacher metrics from the reference.
+
+        Returns:
+            False if there is no reference or it does not cover the teacher poses
+        """
+        frames = len(self.poses["teacher"])
+        start = self.reference_start
+        if self.reference is None or frames == 0 or start + frames > self.reference.frames:
+            return False
+        rows = self._metric_rows("teacher", frames)
+        rows[Metric.POSITION, :, :frames] = self.reference.angles[:, start:start + frames]
+        rows[Metric.VELOCITY, :, :frames - 1] = self.reference.velocities[:, start:start + frames - 1]
+        return True
+
+    def _calc_dance_metrics_loop(self, dancer):
+        """Per-frame reference implementation of _calc_dance_metrics.
+
+        Kept for benchmarking and for checking the vectorized path against it.
+        """
+        # select data
+        if(dancer != "student" and dancer != "teacher"):
+            raise Exception("Selected dancer must be a student or teacher")
+
+        # Make room for the metrics and look the per-joint views up once
+        self._metric_rows(dancer, len(self.poses[dancer]))
+        position_metrics = self.position_metrics[dancer]
+        velocity_metrics = self.velocity_metrics[dancer]
 
         for i, pose in enumerate(self.poses[dancer]):
             joint_angle_args = {
@@ -190,7 +394,7 @@ class DanceScorer:
 
             # Calculate all of the joint angles and write them to the position metrics dictionary
             for joint, args in joint_angle_args.items():
-                self.position_metrics[dancer][joint][i] = self._calc_angle(*args)
+                position_metrics[joint][i] = self._calc_angle(*args)
 
 
             if(i > 0):
@@ -209,7 +413,7 @@ class DanceScorer:
                 }
 
                 for joint, args in joint_vel_args.items():
-                    self.velocity_metrics[dancer][joint][i-1] = self._calc_velocity(*args)
+                    velocity_metrics[joint][i-1] = self._calc_velocity(*args)
 
     def add_frame_pose(self, student_pose, teacher_pose):
         """Add pose from a pair of frames from the student and teacher.
@@ -223,81 +427,31 @@ class DanceScorer:
         self.poses["teacher"].append(teacher_pose)
 
 
-    def generate_wireframe_video(self, fname):
+    def generate_wireframe_video(self, fname, scale=1.0):
+        """Writes the teacher (top, red) and student (bottom, blue) skeletons to a video.
+
+        Args:
+            fname: Path of the output video
+            scale: Output size relative to the 1920x1080 input videos
+        """
+        # Imported here as the renderer itself builds on this module
+        from wireframe import WireframeRenderer
+
+        renderer = WireframeRenderer(scale = scale)
         api = cv2.CAP_FFMPEG
         code = cv2.VideoWriter.fourcc('m', 'p', '4', 'v')
-        output = cv2.VideoWriter(fname, api, code, 30, (1920,1080*2))
-
-        # Resolution of the video frames
-        resolution = (1920,1080)
-
-
-        joint_connections = [
-            [Joint.NECK, Joint.NOSE],
-            [Joint.NECK, Joint.LSHOULDER],
-            [Joint.LSHOULDER, Joint.LELBOW],
-            [Joint.LELBOW, Joint.LWRIST],
-            [Joint.NECK, Joint.RSHOULDER],
-            [Joint.RSHOULDER, Joint.RELBOW],
-            [Joint.RELBOW, Joint.RWRIST],
-            [Joint.NECK, Joint.MIDHIP],
-            [Joint.MIDHIP, Joint.LHIP],
-            [Joint.LHIP, Joint.LKNEE],
-            [Joint.LKNEE, Joint.LANKLE],
-            [Joint.LANKLE, Joint.LBIGTOE],
-            [Joint.MIDHIP, Joint.RHIP],
-            [Joint.RHIP, Joint.RKNEE],
-            [Joint.RKNEE, Joint.RANKLE],
-            [Joint.RANKLE, Joint.RBIGTOE]
-        ]
+        output = cv2.VideoWriter(fname, api, code, 30, renderer.frame_size)
 
         print(len(self.poses["student"]))
         print(len(self.poses["teacher"]))
-        with tqdm(total=len(self.poses["student"]), desc='Writing') as pbar:
-            for pose_student, pose_teacher in zip(self.poses["student"], self.poses["teacher"]):
-                image_student = np.zeros(shape = (resolution[1], resolution[0], 3), dtype = np.uint8)
-                image_teacher = np.zeros(shape = (resolution[1], resolution[0], 3), dtype = np.uint8)
-
-                for connection in joint_connections:
-                    if(pose_student[0, connection[0], 2] > 0.1 and pose_student[0, connection[1], 2] > 0.1):
-                        start_point = tuple(pose_student[0, connection[0], 0:2])
-
-                        # End coordinate, here (250, 250)
-                        # represents the bottom right corner of image
-                        end_point = tuple(pose_student[0, connection[1], 0:2])
-
-                        # Green color in BGR
-                        color = (255, 0, 0)
-
-                        # Line thickness of 9 px
-                        thickness = 9
-
-                        # Using cv2.line() method
-                        # Draw a diagonal green line with thickness of 9 px
-                        image_student = cv2.line(image_student, start_point, end_point, color, thickness)
-
-                    if(pose_teacher[0, connection[0], 2] > 0.1 and pose_teacher[0, connection[1], 2] > 0.1):
-                        start_point = tuple(pose_teacher[0, connection[0], 0:2])
-
-                        # End coordinate, here (250, 250)
-                        # represents the bottom right corner of image
-                        end_point = tuple(pose_teacher[0, connection[1], 0:2])
-
-                        # Green color in BGR
-                        color = (0, 0, 255)
-
-                        # Line thickness of 9 px
-                        thickness = 9
-
-                        # Using cv2.line() method
-                        # Draw a diagonal green line with thickness of 9 px
-                        image_teacher = cv2.line(image_teacher, start_point, end_point, color, thickness)
-
-                image = np.concatenate((image_teacher, image_student), axis=0)
+        frames = min(len(self.poses["student"]), len(self.poses["teacher"]))
+        with profiling.stage("encode.wireframe", frames), tqdm(total=frames, desc='Writing') as pbar:
+            for image in renderer.render(self.poses["student"], self.poses["teacher"]):
                 output.write(image)
                 pbar.update(1)
         output.release()
 
+    @profiling.timed("score")
     def score_dancer(self):
         """Generates a score rating the quality of the dancer.
 
@@ -308,100 +462,48 @@ class DanceScorer:
         self._calc_dance_metrics("student")
         self._calc_dance_metrics("teacher")
 
+        frames = min(self.metric_lengths)
+        positions = self.metrics[:, Metric.POSITION, :, :frames]
 
+        # Joints missing from either dancer are zeroed in both, so they count as zero error
+        missing = np.any(positions == -1, axis = 0)
+        positions[:, missing] = 0
+        position_errors = np.abs(positions[Dancer.STUDENT] - positions[Dancer.TEACHER])
 
-        position_errors = {
-                "lshoulder" : None,
-                "rShoulder" : None,
-                "lelbow" : None,
-                "relbow" : None,
-                "lhip" : None,
-                "rhip" : None,
-                "lknee" : None,
-                "rknee" : None,
-                "lankle" : None,
-                "rankle" : None
-            }
-
-        velocity_errors = {
-            "lshoulder" : None,
-            "rShoulder" : None,
-            "lelbow" : None,
-            "relbow" : None,
-            "lhip" : None,
-            "rhip" : None,
-            "lknee" : None,
-            "rknee" : None,
-            "lankle" : None,
-            "rankle" : None
-        }
-
-        avg_position_errors = {
-            "lshoulder" : None,
-            "rShoulder" : None,
-            "lelbow" : None,
-            "relbow" : None,
-            "lhip" : None,
-            "rhip" : None,
-            "lknee" : None,
-            "rknee" : None,
-            "lankle" : None,
-            "rankle" : None
-        }
+        return self._scores_from_errors(position_errors.mean(axis = 1))
 
-        avg_velocity_errors = {
-            "lshoulder" : None,
-            "rShoulder" : None,
-            "lelbow" : None,
-            "relbow" : None,
-            "lhip" : None,
-            "rhip" : None,
-            "lknee" : None,
-            "rknee" : None,
-            "lankle" : None,
-            "rankle" : None
-        }
+    def _scores_from_errors(self, avg_position_errors):
+        """Converts average per-joint position errors into scores.
 
-        scores = {
-            "lshoulder" : None,
-            "rShoulder" : None,
-            "lelbow" : None,
-            "relbow" : None,
-            "lhip" : None,
-            "rhip" : None,
-            "lknee" : None,
-            "rknee" : None,
-            "lankle" : None,
-            "rankle" : None
-        }
-
-        for joint in position_errors:
-            for i in range(self.position_metrics['student'][joint].shape[0]):
-                if self.position_metrics['student'][joint][i]==-1 or self.position_metrics['teacher'][joint][i]==-1:
-                    self.position_metrics['student'][joint][i] = 0
-                    self.position_metrics['teacher'][joint][i] = 0
-            position_errors[joint] = np.linalg.norm(np.expand_dims(self.position_metrics["student"][joint] - self.position_metrics["teacher"][joint], axis = 1), axis = 1)
-            velocity_errors[joint] = np.linalg.norm(np.expand_dims(self.velocity_metrics["student"][joint] - self.velocity_metrics["teacher"][joint], axis = 1), axis = 1)
+        Args:
+            avg_position_errors: A dictionary mapping each scored joint to its average angle error,
+                or an array of them indexed by ScoredJoint
 
-            avg_position_errors[joint] = np.average(position_errors[joint])
-            avg_velocity_errors[joint] = np.average(velocity_errors[joint])
+        Returns:
+            A dictionary containing scores for individual limbs as well as an overall score
+        """
+        if isinstance(avg_position_errors, dict):
+            avg_position_errors = [avg_position_errors[joint.key] for joint in ScoredJoint]
 
-            sigma = DanceScorer.RANGE[joint]/DanceScorer.SIGMA_SCALE
+        scores = {}
+        for joint in ScoredJoint:
+            sigma = DanceScorer.RANGE[joint.key]/DanceScorer.SIGMA_SCALE
 
             z = avg_position_errors[joint]/sigma
-            scores[joint] = (-1*(norm.cdf(abs(z))*2-1))+1
+            # Two-sided normal tail probability, (-1*(norm.cdf(abs(z))*2-1))+1 without importing scipy.stats
+            scores[joint.key] = 1 - math.erf(abs(z)/math.sqrt(2))
 
         total = 0
         avg = 0
 
         for joint, score in scores.items():
-            # Scale score by 2.5 to make it less disheartening
-            # With the current scheme, the scores are very low, scale them up so they saturate the 0-100 spectrum better
             if(score != 1):
-                avg += 2.2*score
+                avg += DanceScorer.AVERAGE_SCALE*score
                 total += 1
 
-        scores["average"] = avg/total
+        # Perfect joints are left out of the average, when all of them are perfect (identical dancers, or
+        # nobody found in either video) the average takes the value it approaches as the errors vanish
+        scores["average"] = avg/total if total else DanceScorer.AVERAGE_SCALE
 
         return scores
 
@@ -419,10 +521,8 @@ if __name__ == "__main__":
                 "numpyfiles/david-choreo.npy",]
 
     test = DanceScorer()
-    data = np.load(datasets[8])
-    test.poses["teacher"] = data
-    data = np.load(datasets[9])
-    test.poses["student"] = data
+    test.poses["teacher"] = PoseBuffer.load(datasets[8])
+    test.poses["student"] = PoseBuffer.load(datasets[9])
     test.generate_wireframe_video("test_combine.mp4")
 
     # # keypoints = np.squeeze(np.load("posekeypoints.npy"))
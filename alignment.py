@@ -1,21 +1,73 @@
+import threading
+from collections import OrderedDict
 import cv2
 from tqdm import tqdm
 import numpy as np
-from alignment_by_row_channels import align as alignment_by_row
+from alignment_by_row_channels import delay_from_peaks, estimate_audio_delay, fingerprint, load_audio
+from file_hashing import cached_file_hash
+import profiling
 
+# Seconds of audio fingerprinted from the start of each video, offsets up to half of it are found
+AUDIO_WINDOW = 30
+# Matches with a lower confidence are ignored and the videos are compared without a shift
+MIN_AUDIO_CONFIDENCE = 0.1
+# Number of video pairs whose offset is remembered
+OFFSET_CACHE_SIZE = 256
 
-def align(fname1, fname2, write=False, outpath1='', outpath2='', offset=0):
+_offsets = OrderedDict()
+_offsets_lock = threading.Lock()
+
+
+def audio_offset(fname1, fname2, window=AUDIO_WINDOW, reference=None):
     '''
-    captures videos and aligns the
+    estimates the offset between two videos from their soundtracks, cached per pair of video contents
     :param fname1: filepath
     :param fname2: filepath
-    :param write: save output videos or not
-    :param outpath1: path for video1 if saving
-    :param outpath2: path for video2 if saving
-    :return: frames1, frames2, fps, shape1, shape2
+    :param window: seconds of audio read from the start of each video
+    :param reference: TeacherReference of fname2, its stored fingerprint replaces decoding the audio of fname2
+    :return: (seconds to skip in video2, seconds to skip in video1), as alignment_by_row_channels.align
+    '''
+    key = (cached_file_hash(fname1), cached_file_hash(fname2), window)
+    with _offsets_lock:
+        if key in _offsets:
+            _offsets.move_to_end(key)
+            profiling.count("audio_offset_cache.hits")
+            return _offsets[key]
+    profiling.count("audio_offset_cache.misses")
+
+    try:
+        with profiling.stage("align.audio_offset"):
+            peaks2 = reference.audio_peaks(window) if reference is not None else None
+            audio1, rate = load_audio(fname1, seconds=window)
+            if peaks2 is not None and rate == reference.audio_rate:
+                delay, confidence = delay_from_peaks(fingerprint(audio1), peaks2, rate, max_offset_seconds=window / 2)
+            else:
+                audio2, _ = load_audio(fname2, seconds=window)
+                delay, confidence = estimate_audio_delay(audio1, audio2, rate, max_offset_seconds=window / 2)
+    except Exception as e:
+        print('Warning: could not estimate the audio offset ({}), comparing the videos unshifted'.format(e))
+        delay, confidence = (0, 0), 0.0
+    if confidence < MIN_AUDIO_CONFIDENCE:
+        delay = (0, 0)
+
+    with _offsets_lock:
+        _offsets[key] = delay
+        if len(_offsets) > OFFSET_CACHE_SIZE:
+            _offsets.popitem(last=False)
+    return delay
+
+
+def open_aligned(fname1, fname2, offset=0, auto_align=True, reference=None):
     '''
-    # delay = alignment_by_row(fname1, fname2, '..')
-    delay = (0,0)
+    opens both videos and seeks them to their aligned start, so no aligned copies are written
+    :param fname1: filepath
+    :param fname2: filepath
+    :param offset: extra offset in ms applied to both videos
+    :param auto_align: shift the videos by the offset found in their audio
+    :param reference: TeacherReference of fname2 whose audio fingerprint is reused
+    :return: cap1, cap2, fps, shape1, shape2
+    '''
+    delay = audio_offset(fname1, fname2, reference=reference) if auto_align else (0, 0)
     cap1 = cv2.VideoCapture(fname1)
     cap2 = cv2.VideoCapture(fname2)
     fps = cap1.get(cv2.CAP_PROP_FPS)
@@ -25,75 +77,130 @@ def align(fname1, fname2, write=False, outpath1='', outpath2='', offset=0):
     frame_height2 = cap2.get(4)
     cap1.set(cv2.CAP_PROP_POS_MSEC, offset + delay[1] * 1000)
     cap2.set(cv2.CAP_PROP_POS_MSEC, offset + delay[0] * 1000)
+    return cap1, cap2, fps, (int(frame_width1), int(frame_height1)), (int(frame_width2), int(frame_height2))
 
-    frames1 = []
-    frames2 = []
-    with tqdm(total=cap1.get(cv2.CAP_PROP_FRAME_COUNT), desc='Processing') as pbar:
+def iter_frames(cap):
+    '''
+    decodes a single video one frame at a time
+    :param cap: opened cv2.VideoCapture
+    :return: generator of frames
+    '''
+    while 1:
+        success, frame = cap.read()
+        if success:
+            yield frame
+        else:
+            break
+
+def iter_aligned_frames(cap1, cap2):
+    '''
+    decodes both videos in lockstep, holding only the current pair of frames
+    :param cap1: opened cv2.VideoCapture
+    :param cap2: opened cv2.VideoCapture
+    :return: generator of (frame1, frame2) until either video runs out
+    '''
+    try:
         while 1:
             success1, frame1 = cap1.read()
             success2, frame2 = cap2.read()
             if success1 and success2:
-                frames1.append(frame1)
-                frames2.append(frame2)
-                pbar.update(1)
+                yield frame1, frame2
             else:
                 break
+    finally:
+        cap1.release()
+        cap2.release()
+
+def align(fname1, fname2, write=False, outpath1='', outpath2='', offset=0, auto_align=True):
+    '''
+    captures videos and aligns the
+    :param fname1: filepath
+    :param fname2: filepath
+    :param write: save output videos or not
+    :param outpath1: path for video1 if saving
+    :param outpath2: path for video2 if saving
+    :param auto_align: shift the videos by the offset found in their audio
+    :return: frames1, frames2, fps, shape1, shape2
+    '''
+    cap1, cap2, fps, shape1, shape2 = open_aligned(fname1, fname2, offset, auto_align)
+
+    frames1 = []
+    frames2 = []
+    with tqdm(total=cap1.get(cv2.CAP_PROP_FRAME_COUNT), desc='Processing') as pbar:
+        for frame1, frame2 in iter_aligned_frames(cap1, cap2):
+            frames1.append(frame1)
+            frames2.append(frame2)
+            pbar.update(1)
     if write:
-        write_video(outpath1, frames1, fps, (int(frame_width1), int(frame_height1)))
-        write_video(outpath2, frames2, fps, (int(frame_width2), int(frame_height2)))
-    return frames1, frames2, fps, (int(frame_width1), int(frame_height1)), (int(frame_width2), int(frame_height2))
+        write_video(outpath1, frames1, fps, shape1)
+        write_video(outpath2, frames2, fps, shape2)
+    return frames1, frames2, fps, shape1, shape2
 
-def write_video(fname, frames, fps, shape):
+def open_writer(fname, fps, shape):
+    '''
+    opens an mp4 writer so frames can be encoded as they are produced
+    :param fname: output file path
+    :param fps: frame rate of the output video
+    :param shape: (width, height) of the output frames
+    :return: cv2.VideoWriter
+    '''
     api = cv2.CAP_FFMPEG
     code = cv2.VideoWriter.fourcc('m', 'p', '4', 'v')
-    output = cv2.VideoWriter(fname, api, code, fps, shape)
-    with tqdm(total=len(frames), desc='Writing') as pbar:
+    return cv2.VideoWriter(fname, api, code, fps, shape)
+
+def write_video(fname, frames, fps, shape):
+    output = open_writer(fname, fps, shape)
+    with profiling.stage("encode.write_video", len(frames)), tqdm(total=len(frames), desc='Writing') as pbar:
         for frame in frames:
             output.write(frame)
             pbar.update(1)
     output.release()
 
+def combined_shape(shape1, shape2):
+    '''
+    :return: (width, height) of the side-by-side frames written by check_alignment
+    '''
+    return (int((shape1[0] + shape2[0])/2), int((shape1[1] + shape2[1]) / 4))
+
+def combine_frames(frame1, frame2, shape):
+    '''
+    pairs two frames side-by-side and resizes the result to shape
+    '''
+    vis = np.concatenate((frame1, frame2), axis=1)
+    return cv2.resize(vis, shape)
+
 def check_alignment(frames1, frames2, fps, shape1, shape2, outpath):
     '''
     Pairs videos side-by-side and saves combined files to outpath
-    :param frames1: list of aligned frames
-    :param frames2: list of aligned frames
+    :param frames1: iterable of aligned frames
+    :param frames2: iterable of aligned frames
     :param fps: int number of fps for output video
     :param shape1: shape of frames1
     :param shape2: shape of frames2
     :param outpath: file path to output combined video
     :return: None
     '''
-    shape = (int((shape1[0] + shape2[0])/2), int((shape1[1] + shape2[1]) / 4))
-    frames = []
-    for i in tqdm(range(len(frames1))):
-        vis = np.concatenate((frames1[i], frames2[i]), axis=1)
-        new_vis = cv2.resize(vis, shape)
-        frames.append(new_vis)
+    write_combined(zip(frames1, frames2), fps, shape1, shape2, outpath)
 
-    write_video(outpath, frames, fps, shape)
+def write_combined(pairs, fps, shape1, shape2, outpath):
+    '''
+    encodes (frame1, frame2) pairs side-by-side as they are produced
+    :param pairs: iterable of aligned frame pairs
+    :return: None
+    '''
+    shape = combined_shape(shape1, shape2)
+    output = open_writer(outpath, fps, shape)
+    for frame1, frame2 in tqdm(pairs):
+        output.write(combine_frames(frame1, frame2, shape))
+    output.release()
 
 def check_alignment_from_files(fname1, fname2, outpath):
     cap1 = cv2.VideoCapture(fname1)
     cap2 = cv2.VideoCapture(fname2)
     fps = cap2.get(cv2.CAP_PROP_FPS)
-    frame_width1 = cap1.get(3)
-    frame_height1 = cap1.get(4)
-    frame_width2 = cap2.get(3)
-    frame_height2 = cap2.get(4)
-
-    frames1 = []
-    frames2 = []
-
-    while 1:
-        success1, frame1 = cap1.read()
-        success2, frame2 = cap2.read()
-        if success1 and success2:
-            frames1.append(frame1)
-            frames2.append(frame2)
-        else:
-            break
-    check_alignment(frames1, frames2, fps, (int(frame_width1), int(frame_height1)), (int(frame_width2), int(frame_height2)), outpath)
+    shape1 = (int(cap1.get(3)), int(cap1.get(4)))
+    shape2 = (int(cap2.get(3)), int(cap2.get(4)))
+    write_combined(iter_aligned_frames(cap1, cap2), fps, shape1, shape2, outpath)
 
 if __name__ == '__main__':
     # frames1, frames2, fps, shape1, shape2 = align('videos/david-ymca.mp4', 'videos/ymca.mp4',
@@ -1,25 +1,63 @@
-import scipy.io.wavfile
+import itertools
 import numpy as np
-from subprocess import call
+import subprocess
+import shutil
 import math
 
-# Extract audio from video file, save as wav auido file
-# INPUT: Video file
-# OUTPUT: Does not return any values, but saves audio as wav file
-def extract_audio(dir, video_file):
-    track_name = video_file.split(".")
-    audio_output = track_name[2] + "WAV.wav"  # !! CHECK TO SEE IF FILE IS IN UPLOADS DIRECTORY
-    output = dir + audio_output
-    call(["avconv", "-y", "-i", dir+video_file, "-vn", "-ac", "1", "-f", "wav", output])
-    return output
+# Decode the audio track of a video straight into memory
+# Uses PyAV as an in-process decoder when it is installed, otherwise pipes raw PCM out of ffmpeg/avconv.
+# No file is written in either case.
+# INPUT: video file, number of seconds to read from the start (None for all), output sample rate
+# OUTPUT: mono int16 numpy array, sample rate
+def load_audio(video_file, seconds=None, rate=44100):
+    try:
+        import av
+    except ImportError:
+        av = None
+    limit = None if seconds is None else int(seconds * rate)
+    if av is not None:
+        data = _decode_audio_av(av, video_file, limit, rate)
+    else:
+        data = _decode_audio_pipe(video_file, seconds, rate)
+    return data[:limit], rate
+
+
+def _decode_audio_av(av, video_file, limit, rate):
+    with av.open(video_file) as container:
+        if not container.streams.audio:
+            return np.zeros(0, dtype=np.int16)
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=rate)
+        # Samples are copied into one preallocated buffer when the length is known
+        buffer = np.zeros(limit, dtype=np.int16) if limit is not None else None
+        chunks = []
+        filled = 0
+        # A final None flushes the samples the resampler still holds
+        for frame in itertools.chain(container.decode(container.streams.audio[0]), [None]):
+            for resampled in resampler.resample(frame):
+                samples = resampled.to_ndarray().reshape(-1)
+                if buffer is not None:
+                    count = min(len(samples), limit - filled)
+                    buffer[filled:filled + count] = samples[:count]
+                    filled += count
+                else:
+                    chunks.append(samples)
+            if buffer is not None and filled >= limit:
+                break
+        if buffer is not None:
+            return buffer[:filled]
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)
 
 
-# Read file
-# INPUT: Audio file
-# OUTPUT: Sets sample rate of wav file, Returns data read from wav file (numpy array of integers)
-def read_audio(audio_file):
-    rate, data = scipy.io.wavfile.read(audio_file)  # Return the sample rate (in samples/sec) and data from a WAV file
-    return data, rate
+def _decode_audio_pipe(video_file, seconds, rate):
+    binary = shutil.which("ffmpeg") or shutil.which("avconv")
+    if binary is None:
+        raise RuntimeError("Decoding audio needs PyAV or an ffmpeg/avconv binary on the PATH")
+    command = [binary, "-v", "error", "-i", video_file, "-vn", "-ac", "1", "-ar", str(rate)]
+    if seconds is not None:
+        command += ["-t", str(seconds)]
+    command += ["-f", "s16le", "-"]
+    result = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+    return np.frombuffer(result.stdout, dtype=np.int16)
 
 
 def make_horiz_bins(data, fft_bin_size, overlap, box_height):
@@ -124,29 +162,135 @@ def find_delay(time_pairs):
     return time_delay
 
 
-# Find time delay between two video files
-def align(video1, video2, dir, fft_bin_size=1024, overlap=0, box_height=512, box_width=43, samples_per_box=7):
-    # Process first file
-    wavfile1 = extract_audio(dir, video1)
-    raw_audio1, rate = read_audio(wavfile1)
-    bins_dict1 = make_horiz_bins(raw_audio1[:44100*120], fft_bin_size, overlap, box_height) #bins, overlap, box height
-    boxes1 = make_vert_bins(bins_dict1, box_width)  # box width
-    ft_dict1 = find_bin_max(boxes1, samples_per_box)  # samples per box
-
-    # Process second file
-    wavfile2 = extract_audio(dir, video2)
-    raw_audio2, rate = read_audio(wavfile2)
-    bins_dict2 = make_horiz_bins(raw_audio2[:44100*60], fft_bin_size, overlap, box_height)
-    boxes2 = make_vert_bins(bins_dict2, box_width)
-    ft_dict2 = find_bin_max(boxes2, samples_per_box)
-
-    # Determie time delay
-    pairs = find_freq_pairs(ft_dict1, ft_dict2)
-    delay = find_delay(pairs)
-    samples_per_sec = float(rate) / float(fft_bin_size)
+# Framed 2-D FFT of the whole signal, replaces make_horiz_bins/fourier without python loops
+# INPUT: audio samples, fft window length, overlap between windows
+# OUTPUT: (frames, fft_bin_size/2) array of magnitudes rounded like fourier(), row x is the x coordinate of make_horiz_bins
+def spectrogram(data, fft_bin_size, overlap):
+    step = int(fft_bin_size - overlap)
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) < fft_bin_size:
+        return np.zeros((0, int(fft_bin_size/2)))
+    frames = np.lib.stride_tricks.sliding_window_view(data, fft_bin_size)[::step]
+    magnitudes = np.abs(np.fft.rfft(frames, axis=1))[:, :int(fft_bin_size/2)]
+    return np.round(magnitudes, 2)
+
+
+# Vectorized make_vert_bins + find_bin_max
+# INPUT: spectrogram from spectrogram(), box size in frequency bins and frames, number of peaks per box
+# OUTPUT: (freqs, times) arrays holding the loudest points of every box
+def find_peaks(intensities, box_height, box_width, maxes_per_box):
+    n_times, n_freqs = intensities.shape
+    if n_times == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    boxes_t = -(-n_times // box_width)
+    boxes_f = -(-n_freqs // box_height)
+
+    # Pad to whole boxes and bring every box's points into the last axis
+    padded = np.full((boxes_t * box_width, boxes_f * box_height), -np.inf)
+    padded[:n_times, :n_freqs] = intensities
+    boxes = padded.reshape(boxes_t, box_width, boxes_f, box_height).transpose(0, 2, 1, 3)
+    boxes = boxes.reshape(boxes_t, boxes_f, box_width * box_height)
+
+    k = min(maxes_per_box, boxes.shape[2])
+    index = np.argpartition(-boxes, k - 1, axis=2)[..., :k]
+    values = np.take_along_axis(boxes, index, axis=2)
+
+    times = np.arange(boxes_t)[:, None, None] * box_width + index // box_height
+    freqs = np.arange(boxes_f)[None, :, None] * box_height + index % box_height
+    # find_bin_max only keeps points louder than its (1,2,3) starting entry
+    keep = values > 1
+    return freqs[keep], times[keep]
+
+
+# Audio fingerprint of a signal as the peaks of its spectrogram
+def fingerprint(data, fft_bin_size=1024, overlap=0, box_height=512, box_width=43, samples_per_box=7):
+    return find_peaks(spectrogram(data, fft_bin_size, overlap), box_height, box_width, samples_per_box)
+
+
+# Histogram of time offsets between matching peaks, replaces find_freq_pairs + find_delay
+# Votes for offset d count the peak pairs with the same frequency and t2 - t1 = d. They are the
+# cross-correlation of the per-frequency peak occupancy of both signals, computed with one FFT per
+# frequency chunk, so no pairs are ever materialized.
+# INPUT: (freqs, times) peaks of both signals, largest |offset| in fft windows to consider (None for all)
+# OUTPUT: (offsets, votes) arrays over the allowed offset range
+def vote_offsets(peaks1, peaks2, max_offset=None, chunk_size=64):
+    freqs1, times1 = peaks1
+    freqs2, times2 = peaks2
+    length1 = int(times1.max()) + 1 if len(times1) else 1
+    length2 = int(times2.max()) + 1 if len(times2) else 1
+    lowest = -(length1 - 1)
+    highest = length2 - 1
+    if max_offset is not None:
+        lowest = max(lowest, -max_offset)
+        highest = min(highest, max_offset)
+    offsets = np.arange(lowest, highest + 1)
+
+    # Only frequencies that occur in both signals can vote
+    shared = np.intersect1d(freqs1, freqs2)
+    fft_length = 1 << int(np.ceil(np.log2(length1 + length2)))
+    spectrum = np.zeros(fft_length // 2 + 1, dtype=np.complex128)
+    for start in range(0, len(shared), chunk_size):
+        chunk = shared[start:start + chunk_size]
+        occupancy1 = np.zeros((len(chunk), fft_length))
+        occupancy2 = np.zeros((len(chunk), fft_length))
+        mask1 = np.isin(freqs1, chunk)
+        mask2 = np.isin(freqs2, chunk)
+        np.add.at(occupancy1, (np.searchsorted(chunk, freqs1[mask1]), times1[mask1]), 1)
+        np.add.at(occupancy2, (np.searchsorted(chunk, freqs2[mask2]), times2[mask2]), 1)
+        spectrum += np.sum(np.conj(np.fft.rfft(occupancy1, axis=1)) * np.fft.rfft(occupancy2, axis=1), axis=0)
+
+    correlation = np.fft.irfft(spectrum, fft_length)
+    # Negative offsets wrap around to the end of the circular correlation
+    votes = np.rint(correlation[offsets % fft_length]).astype(np.int64)
+    return offsets, votes
+
+
+# Pick the winning offset and how far it is ahead of the best other offset
+# OUTPUT: offset in fft windows, confidence in [0, 1] (0 for a tie, 1 when no other offset got votes)
+def pick_offset(offsets, votes):
+    if len(votes) == 0 or votes.max() <= 0:
+        return 0, 0.0
+    best = int(np.argmax(votes))
+    # Neighbouring offsets share votes of the winner when peaks straddle two fft windows
+    others = votes.copy()
+    others[max(best - 1, 0):best + 2] = 0
+    runner_up = others.max() if len(others) else 0
+    return int(offsets[best]), 1.0 - float(runner_up) / float(votes[best])
+
+
+# Find time delay between two audio signals, with the confidence of the match
+# OUTPUT: ((seconds, 0) if the second signal lags the first, otherwise (0, seconds)), confidence
+def estimate_audio_delay(raw_audio1, raw_audio2, rate, fft_bin_size=1024, overlap=0, box_height=512, box_width=43, samples_per_box=7, max_offset_seconds=None):
+    peaks1 = fingerprint(raw_audio1, fft_bin_size, overlap, box_height, box_width, samples_per_box)
+    peaks2 = fingerprint(raw_audio2, fft_bin_size, overlap, box_height, box_width, samples_per_box)
+    return delay_from_peaks(peaks1, peaks2, rate, fft_bin_size, overlap, max_offset_seconds)
+
+
+# Same as estimate_audio_delay for signals that were already fingerprinted, e.g. a stored teacher reference
+# INPUT: (freqs, times) peaks of both signals from fingerprint()
+def delay_from_peaks(peaks1, peaks2, rate, fft_bin_size=1024, overlap=0, max_offset_seconds=None):
+    samples_per_sec = float(rate) / float(fft_bin_size - overlap)
+    max_offset = None if max_offset_seconds is None else int(np.ceil(max_offset_seconds * samples_per_sec))
+    delay, confidence = pick_offset(*vote_offsets(peaks1, peaks2, max_offset))
     seconds= round(float(delay) / float(samples_per_sec), 4)
 
     if seconds > 0:
-        return (seconds, 0)
+        return (seconds, 0), confidence
     else:
-        return (0, abs(seconds))
\ No newline at end of file
+        return (0, abs(seconds)), confidence
+
+
+# Find time delay between two audio signals
+# OUTPUT: (seconds, 0) if the second signal lags the first, otherwise (0, seconds)
+def find_audio_delay(raw_audio1, raw_audio2, rate, fft_bin_size=1024, overlap=0, box_height=512, box_width=43, samples_per_box=7, max_offset_seconds=None):
+    return estimate_audio_delay(raw_audio1, raw_audio2, rate, fft_bin_size, overlap, box_height, box_width, samples_per_box, max_offset_seconds)[0]
+
+
+# Find time delay between two video files
+def align(video1, video2, dir, fft_bin_size=1024, overlap=0, box_height=512, box_width=43, samples_per_box=7):
+    # Only the start of each track is fingerprinted, so only that much is decoded
+    raw_audio1, rate = load_audio(dir + video1, seconds=120)
+    raw_audio2, rate = load_audio(dir + video2, seconds=60)
+
+    return find_audio_delay(raw_audio1, raw_audio2, rate,
+                            fft_bin_size, overlap, box_height, box_width, samples_per_box)
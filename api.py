@@ -1,30 +1,150 @@
 import sys
 from flask import Flask, request 
 import os
-import pose_estimation
 import json
 import time
+import threading
+from estimator_pool import EstimatorPool
+from jobs import JobManager, QueueFull
+from keypoint_cache import KeypointCache
+from video_encoding import VideoEncoder
+import profiling
 
 app = Flask(__name__)
 
 os.environ["FLASK_ENV"] = "development"
 
+# Number of warm PoseEstimators shared by all requests
+POOL_SIZE = int(os.environ.get("DEEPDANCE_POOL_SIZE", 1))
+
+# Keypoints of every processed video are cached here so repeated teacher videos skip inference
+CACHE_DIR = os.environ.get("DEEPDANCE_CACHE_DIR", "cache/keypoints")
+CACHE_BYTES = int(os.environ.get("DEEPDANCE_CACHE_BYTES", 2 * 1024 ** 3))
+
+# Number of comparisons run at the same time, defaults to the pool size
+JOB_WORKERS = int(os.environ.get("DEEPDANCE_JOB_WORKERS", POOL_SIZE))
+
+# Jobs allowed to wait for a worker, finished jobs kept and seconds they are kept for, older
+# and surplus finished jobs are removed with their files even if nobody deletes them
+MAX_QUEUED = int(os.environ.get("DEEPDANCE_MAX_QUEUED", 64))
+MAX_FINISHED = int(os.environ.get("DEEPDANCE_MAX_FINISHED", 256))
+JOB_TTL = float(os.environ.get("DEEPDANCE_JOB_TTL", 3600))
+
+# Stage timings, counters and peaks are recorded for every job unless this is set to 0
+PROFILE = os.environ.get("DEEPDANCE_PROFILE", "1") != "0"
+
+# Worker processes rendering the output videos of a job in parallel, 0 keeps the inline writers
+ENCODE_WORKERS = int(os.environ.get("DEEPDANCE_ENCODE_WORKERS", os.cpu_count() or 1))
+
+# Inference runs on every DEEPDANCE_KEYFRAME_INTERVAL-th frame, or on frames changing by more than
+# DEEPDANCE_MOTION_THRESHOLD gray levels, and the keypoints in between are interpolated
+KEYFRAME_INTERVAL = int(os.environ.get("DEEPDANCE_KEYFRAME_INTERVAL", 1))
+MOTION_THRESHOLD = float(os.environ["DEEPDANCE_MOTION_THRESHOLD"]) if os.environ.get("DEEPDANCE_MOTION_THRESHOLD") else None
+INTERPOLATION = os.environ.get("DEEPDANCE_INTERPOLATION", "linear")
+
+# Backend inputs are downscaled to fit DEEPDANCE_NET_RESOLUTION, e.g. -1x368, and cropped to the
+# dancers unless DEEPDANCE_CROP_TO_DANCER is 0, empty keeps the decoded frames as they are
+NET_RESOLUTION = os.environ.get("DEEPDANCE_NET_RESOLUTION") or None
+CROP_TO_DANCER = os.environ.get("DEEPDANCE_CROP_TO_DANCER", "1") != "0" and NET_RESOLUTION is not None
+
+_pool = None
+_jobs = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+	# The pool is created on first use so importing the app stays cheap
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			encoder = VideoEncoder(ENCODE_WORKERS) if ENCODE_WORKERS > 0 else None
+			_pool = EstimatorPool(POOL_SIZE, keypoint_cache=KeypointCache(CACHE_DIR, CACHE_BYTES), encoder=encoder,
+								  keyframe_interval=KEYFRAME_INTERVAL, motion_threshold=MOTION_THRESHOLD,
+								  interpolation=INTERPOLATION, net_resolution=NET_RESOLUTION,
+								  crop_to_dancer=CROP_TO_DANCER)
+	return _pool
+
+
+def get_jobs():
+	global _jobs
+	pool = get_pool()
+	with _pool_lock:
+		if _jobs is None:
+			_jobs = JobManager(pool, JOB_WORKERS, profile=PROFILE, max_queued=MAX_QUEUED,
+							   max_finished=MAX_FINISHED, ttl=JOB_TTL)
+	return _jobs
+
+
+@app.route("/health", methods=["GET"])
+def health():
+	if _pool is None:
+		return json.dumps({"status" : "starting", "pool" : None})
+	return json.dumps({"status" : "ok", "pool" : _pool.stats(), "jobs" : _jobs.stats() if _jobs else {}})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+	# Totals over every finished job since the server started
+	return json.dumps({"enabled" : PROFILE, "totals" : profiling.totals.as_dict()})
+
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+	if 'teacher' not in request.files or 'student' not in request.files:
+		return json.dumps({"error" : "teacher and student videos are required"}), 400
+	try:
+		job = get_jobs().submit(request.files['teacher'], request.files['student'])
+	except QueueFull as e:
+		return json.dumps({"error" : str(e)}), 503
+	return json.dumps({"job_id" : job.id, "status" : job.status}), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+	job = get_jobs().get(job_id)
+	if job is None:
+		return json.dumps({"error" : "unknown job"}), 404
+	return json.dumps(job.as_dict())
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def job_result(job_id):
+	job = get_jobs().get(job_id)
+	if job is None:
+		return json.dumps({"error" : "unknown job"}), 404
+	if job.status == "failed":
+		return json.dumps({"status" : job.status, "error" : job.error}), 500
+	if job.status != "done":
+		return json.dumps({"status" : job.status}), 409
+	return json.dumps({"status" : job.status, "scores" : job.scores, "outputs" : job.outputs, "profile" : job.profile})
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def delete_job(job_id):
+	if not get_jobs().delete(job_id):
+		return json.dumps({"error" : "unknown or unfinished job"}), 404
+	return json.dumps({"deleted" : job_id})
+
 
 @app.route("/test", methods=["POST"])
 def create(): 
-	request.files['teacher'].save("/home/david/Documents/DeepDance/deepdance/videos/master.mp4")
-	request.files['student'].save("/home/david/Documents/DeepDance/deepdance/videos/student.mp4")
-
-	pose_estimator = pose_estimation.PoseEstimator()
-	result = json.dumps(pose_estimator.compare_videos("/home/david/Documents/DeepDance/deepdance/videos/student.mp4",
-													"/home/david/Documents/DeepDance/deepdance/videos/master.mp4",
-													write_skeleton=True,
-													  skeleton_out1="/home/david/Documents/DeepDance/deepdance/videos/student-overlay.mp4",
-													  skeleton_out2="/home/david/Documents/DeepDance/deepdance/videos/master-overlay.mp4",
-                       write_aligned=False, aligned_out1='videos/aligned-david-choreo.mp4', aligned_out2='videos/aligned-davidcaro-choreo.mp4',
-                       write_combined=False, combined_out='verification/david-caro-choreo.mp4'))
-	pose_estimator.get_wireframe("/home/david/Documents/DeepDance/deepdance/videos/black-wireframe.mp4")
-	return result # return scores
+	# Synchronous variant of /jobs kept for the frontend, files still go to a per-request directory
+	jobs = get_jobs()
+	try:
+		# The frontend only reads the scores, so no output videos are rendered
+		job = jobs.submit(request.files['teacher'], request.files['student'], render=False)
+	except QueueFull as e:
+		return json.dumps({"error" : str(e)}), 503
+	job.future.result()
+	jobs.delete(job.id)
+	if job.status != "done":
+		return json.dumps({"error" : job.error}), 500
+	if request.args.get("profile", "0") not in ("0", "false", ""):
+		# The frontend reads the scores at the top level, so the profile is opt-in here
+		return json.dumps(dict(job.scores, profile=job.profile))
+	return json.dumps(job.scores) # return scores
 
 if __name__ == "__main__":
+	# Warm the estimators before accepting requests
+	get_pool()
 	app.run(debug=False, host='127.0.0.1', port=5000)
\ No newline at end of file
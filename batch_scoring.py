@@ -0,0 +1,117 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from DanceScorer import ANGLE_JOINTS, DanceScorer, calc_joint_angles, stack_poses
+
+# Columns of the arrays returned by BatchScorer.score_array
+SCORE_COLUMNS = list(ANGLE_JOINTS) + ["average"]
+
+
+def stack_students(students, frames=None):
+    """Pads student sequences of different lengths into one array.
+
+    Args:
+        students: An (S, N, 25, 3) or (S, N, 1, 25, 3) array, or a list of anything accepted by stack_poses
+        frames: Sequences are cut to this many frames if given, e.g. the length of the teacher
+
+    Returns:
+        An (S, L, 25, 3) float32 array where padded frames have zero confidence, and the
+        number of real frames of every student
+    """
+    if isinstance(students, np.ndarray):
+        students = students.reshape(students.shape[0], students.shape[1], -1, 25, 3)[:, :, 0]
+        if frames is not None:
+            students = students[:, :frames]
+        return students.astype(np.float32), np.full(len(students), students.shape[1], dtype = np.intp)
+
+    sequences = [stack_poses(student) for student in students]
+    if frames is not None:
+        sequences = [sequence[:frames] for sequence in sequences]
+    lengths = np.array([len(sequence) for sequence in sequences], dtype = np.intp)
+    stacked = np.zeros(shape = (len(sequences), lengths.max() if len(lengths) else 0, 25, 3), dtype = np.float32)
+    for stacked_sequence, sequence in zip(stacked, sequences):
+        stacked_sequence[:len(sequence)] = sequence
+    return stacked, lengths
+
+
+def angle_errors(teacher_angles, students, lengths):
+    """Average joint angle error of every student against the teacher in one pass.
+
+    Frames where a joint is missing in either dancer count as zero error, and every
+    student is averaged over its own frames, as in DanceScorer.score_dancer.
+
+    Args:
+        teacher_angles: (N, 10) angles of the teacher from calc_joint_angles
+        students: (S, L, 25, 3) poses with L <= N
+        lengths: Number of real frames of every student
+
+    Returns:
+        An (S, 10) float64 array of average errors ordered like ANGLE_JOINTS
+    """
+    count, frames = students.shape[:2]
+    angles = calc_joint_angles(students.reshape(count*frames, 25, 3)).reshape(count, frames, -1)
+    teacher = teacher_angles[None, :frames]
+    valid = (angles != -1) & (teacher != -1) & (np.arange(frames)[None, :, None] < lengths[:, None, None])
+    errors = np.where(valid, np.abs(angles - teacher), 0).sum(axis = 1, dtype = np.float64)
+    return errors/np.maximum(lengths, 1)[:, None]
+
+
+def _score_chunk(teacher_angles, students):
+    stacked, lengths = stack_students(students, len(teacher_angles))
+    return angle_errors(teacher_angles, stacked, lengths)
+
+
+class BatchScorer:
+    """Scores many students against one teacher.
+
+    The teacher joint angles are computed once when the scorer is created. Students are
+    padded into a single array and scored in one vectorized pass, or split into chunks
+    across a process pool for large batches. Each student is compared with the teacher
+    over the frames both have, so students longer than the teacher are cut short.
+    """
+
+    def __init__(self, teacher):
+        """
+        Args:
+            teacher: Teacher poses, anything accepted by stack_poses
+        """
+        self.teacher_angles = calc_joint_angles(stack_poses(teacher))
+        self._scorer = DanceScorer()
+
+    def errors(self, students, workers=1, chunk_size=16):
+        """Average joint angle errors of every student.
+
+        Args:
+            students: An (S, N, 25, 3) array or a list of sequences of any length
+            workers: Number of worker processes, the batch is scored in-process if 1
+            chunk_size: Students per task when workers > 1
+
+        Returns:
+            An (S, 10) float64 array ordered like ANGLE_JOINTS
+        """
+        if workers <= 1 or len(students) <= chunk_size:
+            return _score_chunk(self.teacher_angles, students)
+        chunks = [students[start:start + chunk_size] for start in range(0, len(students), chunk_size)]
+        with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn")) as executor:
+            results = executor.map(_score_chunk, [self.teacher_angles]*len(chunks), chunks)
+            return np.concatenate(list(results))
+
+    def score(self, students, workers=1, chunk_size=16):
+        """Scores every student.
+
+        Returns:
+            A list with one dictionary per student, laid out like DanceScorer.score_dancer
+        """
+        errors = self.errors(students, workers, chunk_size)
+        return [self._scorer._scores_from_errors(row) for row in errors]
+
+    def score_array(self, students, workers=1, chunk_size=16):
+        """Scores every student as one table.
+
+        Returns:
+            An (S, 11) float64 array with columns SCORE_COLUMNS
+        """
+        return np.array([[scores[column] for column in SCORE_COLUMNS]
+                         for scores in self.score(students, workers, chunk_size)])
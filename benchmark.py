@@ -0,0 +1,671 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import cv2
+
+import alignment_by_row_channels as audio
+import profiling
+from alignment import open_writer
+from batch_scoring import BatchScorer, SCORE_COLUMNS
+from DanceScorer import ANGLE_JOINTS, MIN_CONFIDENCE, DanceScorer, draw_skeleton
+from input_preparation import InputPreparer, restore_keypoints
+from keyframes import KeyframeSelector, interpolate_keypoints
+from pose_backends import StubBackend
+from pose_buffer import PoseBuffer
+from pose_estimation import PoseEstimator
+from streaming_scorer import StreamingDanceScorer
+from time_warp import score_dancer_warped
+from video_encoding import VideoEncoder
+from wireframe import WireframeRenderer
+
+
+def time_call(fn, repeat=3):
+    '''
+    Runs fn several times and keeps the fastest wall time
+    :param fn: callable taking no arguments
+    :param repeat: number of runs
+    :return: best time in seconds
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_metrics(fixtures):
+    '''
+    Compares the vectorized metric engine against the per-frame loop
+    :param fixtures: list of .npy keypoint files
+    :return: None, raises AssertionError if the two paths disagree
+    '''
+    for fname in fixtures:
+        poses = np.load(fname)
+        loop = DanceScorer()
+        loop.poses["student"] = list(poses)
+        vectorized = DanceScorer()
+        vectorized.poses["student"] = list(poses)
+
+        t_loop = time_call(lambda: loop._calc_dance_metrics_loop("student"), repeat=1)
+        t_vec = time_call(lambda: vectorized._calc_dance_metrics("student"))
+
+        for joint in loop.position_metrics["student"]:
+            np.testing.assert_allclose(vectorized.position_metrics["student"][joint],
+                                       loop.position_metrics["student"][joint], rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(vectorized.velocity_metrics["student"][joint],
+                                       loop.velocity_metrics["student"][joint], rtol=1e-5, atol=1e-6)
+
+        print("{}: {} frames, loop {:.1f} ms, vectorized {:.2f} ms, {:.0f}x".format(
+            fname, len(poses), t_loop * 1000, t_vec * 1000, t_loop / t_vec))
+
+
+def check_streaming(student, teacher, degenerate_frame=10):
+    '''
+    Feeds a fixture pair to StreamingDanceScorer frame by frame
+    :param student: .npy keypoints of the student
+    :param teacher: .npy keypoints of the teacher
+    :param degenerate_frame: frame whose student elbow is put on top of the wrist in a second run
+    :return: None, raises AssertionError if the running scores differ from score_dancer, a
+             degenerate joint spoils the later scores or a perfect match cannot be scored
+    '''
+    student = np.load(student)
+    teacher = np.load(teacher)
+    frames = min(len(student), len(teacher))
+
+    def stream(student):
+        scorer = StreamingDanceScorer()
+        for student_pose, teacher_pose in zip(student[:frames], teacher[:frames]):
+            scorer.add_frame_pose(student_pose, teacher_pose)
+        return scorer
+
+    scorer = stream(student)
+    expected = scorer.score_dancer()
+    current = scorer.current_scores()
+    for key in expected:
+        assert np.isclose(current[key], expected[key], rtol=1e-5, atol=1e-7), (key, current[key], expected[key])
+
+    # Confident keypoints on top of each other give a NaN angle
+    broken = student.copy()
+    broken[degenerate_frame, 0, [3, 4]] = broken[degenerate_frame, 0, 2]
+    scorer = stream(broken)
+    for scores in (scorer.current_scores(), scorer.window_scores(2)):
+        assert all(np.isfinite(score) for score in scores.values()), scores
+
+    # Identical dancers, and frames where nobody was found, leave every joint without error
+    for pose in (student[0], np.zeros_like(student[0])):
+        scorer = StreamingDanceScorer()
+        for _ in range(10):
+            scorer.add_frame_pose(pose, pose)
+        for scores in (scorer.current_scores(), scorer.window_scores(1), scorer.score_dancer()):
+            assert scores["average"] == DanceScorer.AVERAGE_SCALE, scores
+    print("streaming scores match score_dancer over {} frames, degenerate joints are skipped".format(frames))
+
+
+def synthetic_video(fname, frames, shape=(320, 180), fps=30, period=20):
+    '''
+    writes an mp4 of a bright square circling on a dark background, which StubBackend follows
+    '''
+    output = open_writer(fname, fps, shape)
+    for i in range(frames):
+        frame = np.full((shape[1], shape[0], 3), 20, dtype=np.uint8)
+        x = int(shape[0] / 2 + shape[0] / 4 * np.cos(2 * np.pi * i / period))
+        y = int(shape[1] / 2 + shape[1] / 4 * np.sin(2 * np.pi * i / period))
+        cv2.rectangle(frame, (x - 15, y - 15), (x + 15, y + 15), (255, 255, 255), -1)
+        output.write(frame)
+    output.release()
+
+
+def video_frame_count(fname):
+    cap = cv2.VideoCapture(fname)
+    count = 0
+    while cap.read()[0]:
+        count += 1
+    cap.release()
+    return count
+
+
+def check_compare_videos(lengths=(60, 240), threaded=(True, False)):
+    '''
+    Runs compare_videos with StubBackend on synthetic videos of different lengths with every writer enabled
+    :return: None, raises AssertionError if a frame is lost, the outputs have the wrong number of frames
+             or the peak bytes of decoded frames in the pipeline grow with the length of the videos
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in threaded:
+            peaks = []
+            for frames in lengths:
+                paths = [os.path.join(directory, "{}-{}.mp4".format(name, frames)) for name in ("student", "teacher")]
+                # The teacher moves differently, identical dancers leave no error to average
+                synthetic_video(paths[0], frames)
+                synthetic_video(paths[1], frames, period=30)
+                outputs = {name: os.path.join(directory, "{}-{}.mp4".format(name, frames))
+                           for name in ("skeleton1", "skeleton2", "aligned1", "aligned2", "combined")}
+                estimator = PoseEstimator(backend=StubBackend(), auto_align=False, threaded=mode)
+                profile = profiling.Profile()
+                with profiling.profiling(profile):
+                    estimator.compare_videos(*paths, write_skeleton=True, skeleton_out1=outputs["skeleton1"],
+                                             skeleton_out2=outputs["skeleton2"], write_aligned=True,
+                                             aligned_out1=outputs["aligned1"], aligned_out2=outputs["aligned2"],
+                                             write_combined=True, combined_out=outputs["combined"])
+                assert len(estimator.dance_scorer.poses["student"]) == frames
+                assert len(estimator.dance_scorer.poses["teacher"]) == frames
+                for name, path in outputs.items():
+                    assert video_frame_count(path) == frames, (name, video_frame_count(path), frames)
+                peaks.append(profile.peaks["pipeline.frame_bytes"])
+            # The queues bound the frames in flight, so longer videos must not hold more of them
+            assert peaks[-1] <= peaks[0], peaks
+            print("compare_videos {}: {} frames written to every output, peak frame bytes {}".format(
+                "threaded" if mode else "sequential", "/".join(map(str, lengths)),
+                "/".join("{:.1f} MB".format(peak / 1e6) for peak in peaks)))
+
+
+def synthetic_music(seconds, rate=44100, seed=0):
+    '''
+    generates a melody of random chords with a little noise, standing in for a music track
+    :return: int16 samples
+    '''
+    rng = np.random.default_rng(seed)
+    note_length = rate // 4
+    t = np.arange(note_length) / rate
+    notes = []
+    for _ in range(int(seconds * 4)):
+        freqs = 110 * 2 ** (rng.integers(0, 48, size=3) / 12)
+        notes.append(sum(np.sin(2 * np.pi * f * t) for f in freqs))
+    signal = np.concatenate(notes) + 0.05 * rng.standard_normal(len(notes) * note_length)
+    return (signal / np.abs(signal).max() * 20000).astype(np.int16)
+
+
+def reference_audio_delay(raw_audio1, raw_audio2, rate, fft_bin_size=1024, overlap=0, box_height=512, box_width=43, samples_per_box=7):
+    '''
+    runs the original dictionary based fingerprinting steps
+    '''
+    boxes1 = audio.make_vert_bins(audio.make_horiz_bins(raw_audio1, fft_bin_size, overlap, box_height), box_width)
+    boxes2 = audio.make_vert_bins(audio.make_horiz_bins(raw_audio2, fft_bin_size, overlap, box_height), box_width)
+    pairs = audio.find_freq_pairs(audio.find_bin_max(boxes1, samples_per_box), audio.find_bin_max(boxes2, samples_per_box))
+    seconds = round(float(audio.find_delay(pairs)) / (float(rate) / float(fft_bin_size)), 4)
+    return (seconds, 0) if seconds > 0 else (0, abs(seconds))
+
+
+def bench_audio(seconds=20, offset=3.0, rate=44100):
+    '''
+    Compares the vectorized audio fingerprinting against the original loops on a
+    synthetic track where the second copy starts offset seconds later
+    :return: None, raises AssertionError if a delay is wrong
+    '''
+    music = synthetic_music(seconds + offset, rate)
+    shift = int(offset * rate)
+    cases = [(music, music[shift:], (0, offset)), (music[shift:], music, (offset, 0))]
+
+    # Delays are measured in whole fft windows
+    resolution = 1024 / rate
+    for audio1, audio2, expected in cases:
+        t_loop = time_call(lambda: reference_audio_delay(audio1, audio2, rate), repeat=1)
+        t_vec = time_call(lambda: audio.find_audio_delay(audio1, audio2, rate))
+        reference = reference_audio_delay(audio1, audio2, rate)
+        vectorized, confidence = audio.estimate_audio_delay(audio1, audio2, rate)
+        assert reference == vectorized, (reference, vectorized)
+        assert np.allclose(vectorized, expected, atol=resolution), (vectorized, expected)
+
+        print("audio delay {} (confidence {:.2f}): loop {:.2f} s, vectorized {:.1f} ms, {:.0f}x".format(
+            vectorized, confidence, t_loop, t_vec * 1000, t_loop / t_vec))
+
+
+def bench_time_warp(student, teacher, frames=10000, lag=15):
+    '''
+    Scores a routine tiled to `frames` frames with and without time warping, with the
+    student running `lag` frames behind the teacher
+    :param student: .npy keypoints of the student
+    :param teacher: .npy keypoints of the teacher
+    :return: None
+    '''
+    student = np.load(student)
+    teacher = np.load(teacher)
+    repeats = frames // min(len(student), len(teacher)) + 1
+    student = np.concatenate([student] * repeats)[:frames]
+    teacher = np.concatenate([teacher] * repeats)[:frames]
+
+    scorer = DanceScorer()
+    scorer.poses["student"] = np.concatenate([teacher[:lag], student])[:frames]
+    scorer.poses["teacher"] = teacher
+    t_warp = time_call(lambda: score_dancer_warped(scorer))
+    warped, offset, path_length = score_dancer_warped(scorer)
+    unwarped = scorer.score_dancer()
+
+    print("time warp on {} frames: {:.0f} ms, offset {}, path {}, average {:.3f} unwarped -> {:.3f} warped".format(
+        frames, t_warp * 1000, offset, path_length, unwarped["average"], warped["average"]))
+
+
+def reference_wireframes(student, teacher, resolution=(1920, 1080)):
+    '''
+    yields the frames of the original generate_wireframe_video loop
+    '''
+    for pose_student, pose_teacher in zip(student, teacher):
+        image_student = np.zeros(shape=(resolution[1], resolution[0], 3), dtype=np.uint8)
+        image_teacher = np.zeros(shape=(resolution[1], resolution[0], 3), dtype=np.uint8)
+        draw_skeleton(image_student, pose_student, (255, 0, 0))
+        draw_skeleton(image_teacher, pose_teacher, (0, 0, 255))
+        yield np.concatenate((image_teacher, image_student), axis=0)
+
+
+def bench_wireframe(student, teacher, scales=(1.0, 0.5)):
+    '''
+    Measures the rendering frame rate of the wireframe video without encoding
+    :param student: .npy keypoints of the student
+    :param teacher: .npy keypoints of the teacher
+    :return: None, raises AssertionError if the full resolution frames differ from the original loop
+    '''
+    student = np.load(student)
+    teacher = np.load(teacher)
+    frames = min(len(student), len(teacher))
+
+    renderer = WireframeRenderer()
+    for i, (expected, image) in enumerate(zip(reference_wireframes(student, teacher), renderer.render(student, teacher))):
+        if i % 50 == 0:
+            assert np.array_equal(expected, image), i
+
+    def consume(images):
+        for _ in images:
+            pass
+
+    t_loop = time_call(lambda: consume(reference_wireframes(student, teacher)), repeat=1)
+    print("wireframe {} frames: loop {:.0f} fps".format(frames, frames / t_loop))
+    for scale in scales:
+        renderer = WireframeRenderer(scale=scale)
+        t_fast = time_call(lambda: consume(renderer.render(student, teacher)))
+        print("  renderer {}x{}: {:.0f} fps, {:.1f}x".format(
+            *renderer.frame_size, frames / t_fast, t_loop / t_fast))
+
+
+def bench_encoding(student, teacher, workers=(1, 2, 4), scale=0.5):
+    '''
+    Times rendering and encoding the wireframe video with different numbers of worker processes
+    :param student: .npy keypoints of the student
+    :param teacher: .npy keypoints of the teacher
+    :return: None
+    '''
+    scorer = DanceScorer()
+    scorer.poses["student"] = np.load(student)
+    scorer.poses["teacher"] = np.load(teacher)
+    frames = min(len(scorer.poses["student"]), len(scorer.poses["teacher"]))
+    with tempfile.TemporaryDirectory() as workdir:
+        fname = os.path.join(workdir, "wireframe.mp4")
+        for count in workers:
+            encoder = VideoEncoder(count)
+            try:
+                job = encoder.wireframe_job(fname, scorer, scale)
+                # The first call also starts the worker processes
+                encoder.encode([job])
+                t_encode = time_call(lambda: encoder.encode([job]), repeat=1)
+            finally:
+                encoder.shutdown()
+            print("encode wireframe {} frames with {} workers: {:.2f} s, {:.0f} fps".format(
+                frames, count, t_encode, frames / t_encode))
+
+
+def bench_batch(teacher, fixtures, students=48):
+    '''
+    Scores many students against one teacher, one DanceScorer per student against one batch
+    :param teacher: .npy keypoints of the teacher
+    :param fixtures: .npy keypoints the students are cut from, with different lengths
+    :return: None, raises AssertionError if the batch scores differ from score_dancer
+    '''
+    teacher = np.load(teacher)
+    poses = [np.load(fname) for fname in fixtures]
+    rng = np.random.default_rng(0)
+    sequences = []
+    for k in range(students):
+        source = poses[k % len(poses)]
+        length = int(rng.integers(len(source) // 2, len(source) + 1))
+        sequences.append(source[:min(length, len(teacher))])
+
+    def score_each():
+        rows = []
+        for sequence in sequences:
+            scorer = DanceScorer()
+            scorer.poses["student"] = sequence
+            scorer.poses["teacher"] = teacher[:len(sequence)]
+            scores = scorer.score_dancer()
+            rows.append([scores[column] for column in SCORE_COLUMNS])
+        return np.array(rows)
+
+    batch = BatchScorer(teacher)
+    np.testing.assert_allclose(batch.score_array(sequences), score_each(), rtol=1e-4, atol=1e-6)
+    t_each = time_call(score_each, repeat=1)
+    t_batch = time_call(lambda: batch.score_array(sequences))
+    print("batch of {} students: one by one {:.0f} ms, batched {:.0f} ms, {:.1f}x".format(
+        students, t_each * 1000, t_batch * 1000, t_each / t_batch))
+
+
+def motion_keyframes(poses, interval, threshold, scale=0.1):
+    '''
+    Runs KeyframeSelector on small wireframe renders of a fixture, which stand in for its video
+    :return: boolean keyframe mask
+    '''
+    selector = KeyframeSelector(interval, threshold)
+    renderer = WireframeRenderer(scale=scale)
+    return np.array([selector.select(frame) for frame in renderer.render(poses, poses)])
+
+
+def bench_keyframes(pairs, intervals=(2, 3, 5, 10), thresholds=(0.1, 0.25, 0.5), max_gap=10):
+    '''
+    Scores the fixture pairs from keyframes only and compares with full rate scoring. Inference
+    dominates compare_videos, so the speedup is the number of frames per estimated frame, less
+    the interpolation time which is reported with it
+    :param pairs: (student, teacher) .npy paths, e.g. from fixture_pairs
+    :param intervals: fixed keyframe intervals to try
+    :param thresholds: motion thresholds to try, with max_gap as the longest gap between keyframes, low
+                       as the wireframes are mostly black and change far less than camera footage
+    :return: None
+    '''
+    pairs = [(np.load(student), np.load(teacher)) for student, teacher in pairs]
+
+    def scores(student, teacher):
+        scorer = DanceScorer()
+        scorer.poses["student"] = student
+        scorer.poses["teacher"] = teacher
+        result = scorer.score_dancer()
+        return np.array([result[joint] for joint in ANGLE_JOINTS]), result["average"]
+
+    full = [scores(student, teacher) for student, teacher in pairs]
+    modes = [("every {}".format(interval), lambda poses, interval=interval: np.arange(len(poses)) % interval == 0)
+             for interval in intervals]
+    modes += [("motion > {:g}".format(threshold), lambda poses, threshold=threshold: motion_keyframes(poses, max_gap, threshold))
+              for threshold in thresholds]
+    print("keyframes on {} fixture pairs, score change against full rate:".format(len(pairs)))
+    for name, select in modes:
+        masks = [(select(student), select(teacher)) for student, teacher in pairs]
+        estimated = sum(mask.sum() for pair in masks for mask in pair)
+        frames = sum(len(mask) for pair in masks for mask in pair)
+        for method in ("linear", "spline"):
+            joint_changes, average_changes = [], []
+            seconds = 0.0
+            for (student, teacher), (student_keys, teacher_keys), (joints, average) in zip(pairs, masks, full):
+                start = time.perf_counter()
+                filled = interpolate_keypoints(student, student_keys, method), interpolate_keypoints(teacher, teacher_keys, method)
+                seconds += time.perf_counter() - start
+                sub_joints, sub_average = scores(*filled)
+                joint_changes.append(np.abs(sub_joints - joints))
+                average_changes.append(abs(sub_average - average))
+            joint_changes = np.concatenate(joint_changes)
+            print("  {:<13} {:<6} {:4.0%} estimated, {:4.1f}x fewer inferences, interpolation {:.2f} ms/1000 frames, "
+                  "joint score change mean {:.4f} max {:.4f}, average change mean {:.4f}".format(
+                      name, method, estimated / frames, frames / estimated, seconds / frames * 1e6,
+                      joint_changes.mean(), joint_changes.max(), np.mean(average_changes)))
+
+
+def bench_input_preparation(fixtures, net_resolution=(-1, 368), resolution=(1920, 1080)):
+    '''
+    Follows the dancer of every fixture with a cropping InputPreparer. The fixture keypoints stand in for
+    the detector: they are moved into the prepared input, rounded to its pixels, dropped where the crop
+    cut them off and mapped back
+    :param fixtures: .npy keypoint paths
+    :param net_resolution: (width, height) the inputs are downscaled to fit
+    :param resolution: (width, height) of the videos the fixtures were estimated on
+    :return: None
+    '''
+    full_pixels = resolution[0] * resolution[1]
+    for crop in (False, True):
+        preparer = InputPreparer(net_resolution, crop=crop)
+        size = preparer.decode_size(*resolution) or resolution
+        frame_scale = size[0] / resolution[0]
+        frame = np.zeros(shape=(size[1], size[0], 3), dtype=np.uint8)
+        frames = pixels = seen = lost = 0
+        errors = []
+        seconds = 0.0
+        for fname in fixtures:
+            preparer.reset()
+            for pose in np.load(fname):
+                start = time.perf_counter()
+                image, crop_box = preparer.prepare(frame, frame_scale)
+                seconds += time.perf_counter() - start
+                confident = pose[..., 2] > MIN_CONFIDENCE
+                found = pose.copy()
+                found[..., 0] = np.round((pose[..., 0] - crop_box.x) * crop_box.scale)
+                found[..., 1] = np.round((pose[..., 1] - crop_box.y) * crop_box.scale)
+                inside = ((found[..., 0] >= 0) & (found[..., 0] < image.shape[1])
+                          & (found[..., 1] >= 0) & (found[..., 1] < image.shape[0]))
+                found[~inside] = 0
+                restored = restore_keypoints(found, crop_box)
+                preparer.follow(restored)
+                kept = confident & inside
+                errors.append(np.abs(restored[kept][:, :2] - pose[kept][:, :2]).ravel())
+                frames += 1
+                pixels += image.shape[0] * image.shape[1]
+                seen += confident.sum()
+                lost += (confident & ~inside).sum()
+        errors = np.concatenate(errors)
+
+        # OpenPose reports None when nobody was found, the next frame is then looked at whole
+        preparer.prepare(frame, frame_scale)
+        for nobody in (None, np.zeros(shape=(0, 25, 3), dtype=np.float32)):
+            restored = restore_keypoints(nobody, crop_box)
+            assert restored.shape == (1, 25, 3) and not restored.any(), restored
+            preparer.follow(restored)
+            assert preparer.box is None
+        print("input {} at {}x{}: decoded {}x{}, {:.0f}% of the full frame pixels reach the backend, {:.3f} ms/frame, "
+              "{:.2%} of keypoints cropped away, mapping error mean {:.2f} max {:.2f} px".format(
+                  "cropped" if crop else "whole frame", *net_resolution, *size, pixels / frames / full_pixels * 100,
+                  seconds / frames * 1000, lost / seen, errors.mean(), errors.max()))
+
+
+# Fixtures replayed by the suite and the results it is compared against
+FIXTURES = "numpyfiles"
+BASELINE = "benchmark_baseline.json"
+
+
+def fixture_pairs(directory=FIXTURES):
+    '''
+    Pairs the fixtures recorded from the same routine, which are the ones with the same number of frames
+    :return: list of (student, teacher) paths
+    '''
+    groups = {}
+    for fname in sorted(glob.glob(os.path.join(directory, "*.npy"))):
+        groups.setdefault(len(np.load(fname, mmap_mode="r")), []).append(fname)
+    return [pair for length in sorted(groups) for pair in itertools.combinations(groups[length], 2)]
+
+
+def tile(poses, scale):
+    '''
+    repeats a routine scale times, which keeps every per-frame error and so the scores
+    '''
+    return np.concatenate([poses] * scale) if scale > 1 else poses
+
+
+def reference_fps(fname, repeat=5):
+    '''
+    Frame rate of the per-frame metric loop, which is kept unchanged, on one fixture. Throughputs are
+    stored relative to it so a baseline recorded on one machine can be checked on another
+    :param fname: .npy keypoints
+    :return: frames per second
+    '''
+    poses = np.load(fname)
+    scorer = DanceScorer()
+    scorer.poses["student"] = list(poses)
+    return len(poses) / time_call(lambda: scorer._calc_dance_metrics_loop("student"), repeat)
+
+
+def measure_pair(student, teacher, scales=(1, 10, 100), wireframe_frames=300, reference=None):
+    '''
+    Scores one fixture pair at every scale
+    :param student: .npy keypoints of the student
+    :param teacher: .npy keypoints of the teacher
+    :param wireframe_frames: frames rendered to measure the wireframe frame rate, 0 to skip
+    :param reference: reference_fps of this run, every throughput is also stored divided by it as a *_speed
+    :return: dictionary with the scores at scale 1 and the throughput and peak memory at every scale
+    '''
+    student = np.load(student)
+    teacher = np.load(teacher)
+
+    def scorer_for(scale):
+        scorer = DanceScorer()
+        scorer.poses["student"] = PoseBuffer.from_array(tile(student, scale))
+        scorer.poses["teacher"] = PoseBuffer.from_array(tile(teacher, scale))
+        return scorer
+
+    result = {"frames" : len(student), "scales" : {}}
+    for scale in scales:
+        frames = len(student) * scale
+        # Short runs are repeated more often, the fastest run is the least disturbed one
+        repeat = max(3, 30 // scale)
+        t_metrics = time_call(lambda: (lambda scorer: (scorer._calc_dance_metrics("student"),
+                                                       scorer._calc_dance_metrics("teacher")))(scorer_for(scale)), repeat)
+        t_score = time_call(lambda: scorer_for(scale).score_dancer(), repeat)
+
+        # Memory is measured on its own run, as tracing slows everything down
+        scorer = scorer_for(scale)
+        tracemalloc.start()
+        scores = scorer.score_dancer()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        if scale == 1:
+            result["scores"] = scores
+        result["scales"][str(scale)] = {
+            "metrics_fps" : frames / t_metrics,
+            "score_fps" : frames / t_score,
+            "peak_bytes" : peak,
+            "average" : scores["average"]
+        }
+        if reference:
+            entry = result["scales"][str(scale)]
+            entry["metrics_speed"] = entry["metrics_fps"] / reference
+            entry["score_speed"] = entry["score_fps"] / reference
+
+    if wireframe_frames:
+        count = min(wireframe_frames, len(student))
+        renderer = WireframeRenderer()
+        def render():
+            for _ in renderer.render(student[:count], teacher[:count]):
+                pass
+        result["wireframe_fps"] = count / time_call(render)
+        if reference:
+            result["wireframe_speed"] = result["wireframe_fps"] / reference
+    return result
+
+
+def run_suite(directory=FIXTURES, scales=(1, 10, 100), wireframe_frames=300):
+    '''
+    :return: dictionary mapping "student|teacher" to the measure_pair result of every fixture pair
+    '''
+    pairs = fixture_pairs(directory)
+    reference = reference_fps(pairs[0][0]) if pairs else None
+    results = {}
+    for student, teacher in pairs:
+        name = "{}|{}".format(os.path.basename(student), os.path.basename(teacher))
+        results[name] = measure_pair(student, teacher, scales, wireframe_frames, reference)
+    return results
+
+
+def find_regressions(results, baseline, score_tolerance=1e-6, max_slowdown=1.5, max_memory_growth=1.25):
+    '''
+    Compares suite results with a stored baseline. Throughputs are compared relative to the reference_fps
+    of their own run, absolute frame rates depend on the machine the baseline was recorded on
+    :param score_tolerance: largest allowed absolute change of any score
+    :param max_slowdown: a relative throughput below baseline / max_slowdown is a regression
+    :param max_memory_growth: a peak memory above baseline * max_memory_growth is a regression
+    :return: list of messages, empty if nothing regressed
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        for joint, score in result["scores"].items():
+            if abs(score - expected["scores"].get(joint, score)) > score_tolerance:
+                regressions.append("{}: {} score {:.6f}, baseline {:.6f}".format(name, joint, score, expected["scores"][joint]))
+        for scale, entry in result["scales"].items():
+            previous = expected["scales"].get(scale)
+            if previous is None:
+                continue
+            if abs(entry["average"] - previous["average"]) > score_tolerance:
+                regressions.append("{} x{}: average {:.6f}, baseline {:.6f}".format(name, scale, entry["average"], previous["average"]))
+            for key in ("metrics_speed", "score_speed"):
+                if key in entry and key in previous and entry[key] < previous[key] / max_slowdown:
+                    regressions.append("{} x{}: {} {:.1f}x the reference loop, baseline {:.1f}x".format(
+                        name, scale, key, entry[key], previous[key]))
+            if entry["peak_bytes"] > previous["peak_bytes"] * max_memory_growth:
+                regressions.append("{} x{}: peak memory {:.1f} MB, baseline {:.1f} MB".format(
+                    name, scale, entry["peak_bytes"] / 2**20, previous["peak_bytes"] / 2**20))
+        if "wireframe_speed" in result and "wireframe_speed" in expected:
+            if result["wireframe_speed"] < expected["wireframe_speed"] / max_slowdown:
+                regressions.append("{}: wireframe_speed {:.2f}x the reference loop, baseline {:.2f}x".format(
+                    name, result["wireframe_speed"], expected["wireframe_speed"]))
+    return regressions
+
+
+def print_report(results, baseline=None):
+    for name, result in results.items():
+        print("{} ({} frames) average {:.4f}{}".format(
+            name, result["frames"], result["scores"]["average"],
+            ", wireframe {:.0f} fps".format(result["wireframe_fps"]) if "wireframe_fps" in result else ""))
+        for scale, entry in result["scales"].items():
+            line = "  x{:<4} metrics {:>9.0f} fps  score {:>9.0f} fps  peak {:>7.1f} MB".format(
+                scale, entry["metrics_fps"], entry["score_fps"], entry["peak_bytes"] / 2**20)
+            previous = (baseline or {}).get(name, {}).get("scales", {}).get(scale)
+            if previous and "score_speed" in entry and "score_speed" in previous:
+                line += "  ({:+.0%} relative score speed vs baseline)".format(entry["score_speed"] / previous["score_speed"] - 1)
+            print(line)
+
+
+def run_micro():
+    bench_metrics(sorted(glob.glob("numpyfiles/*.npy")))
+    check_streaming("numpyfiles/david-ymca.npy", "numpyfiles/caro-ymca.npy")
+    check_compare_videos()
+    bench_audio()
+    bench_time_warp("numpyfiles/david-choreo.npy", "numpyfiles/davidcaro-choreo.npy")
+    bench_wireframe("numpyfiles/caro1.npy", "numpyfiles/caro2.npy")
+    bench_encoding("numpyfiles/caro1.npy", "numpyfiles/caro2.npy")
+    bench_batch("numpyfiles/caro-ymca.npy", ["numpyfiles/david-ymca.npy", "numpyfiles/null-ymca.npy", "numpyfiles/FF-caro-ymca.npy"])
+    bench_keyframes(fixture_pairs())
+    bench_input_preparation(sorted(glob.glob("numpyfiles/*.npy")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays the numpyfiles fixtures through DanceScorer and compares against a baseline")
+    parser.add_argument("--micro", action="store_true", help="run the individual micro benchmarks instead of the suite")
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--wireframe-frames", type=int, default=300)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--score-tolerance", type=float, default=1e-6)
+    parser.add_argument("--max-slowdown", type=float, default=1.5)
+    parser.add_argument("--max-memory-growth", type=float, default=1.25)
+    args = parser.parse_args()
+
+    if args.micro:
+        run_micro()
+        sys.exit(0)
+
+    results = run_suite(args.fixtures, args.scales, args.wireframe_frames)
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("baseline written to {}".format(args.baseline))
+    elif baseline is not None:
+        regressions = find_regressions(results, baseline, args.score_tolerance, args.max_slowdown, args.max_memory_growth)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        sys.exit(1 if regressions else 0)
+    else:
+        print("no baseline at {}, run with --update-baseline to create one".format(args.baseline))
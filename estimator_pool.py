@@ -0,0 +1,73 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import profiling
+from pose_estimation import PoseEstimator
+
+
+class EstimatorPool:
+    """Process-wide pool of pre-warmed PoseEstimators.
+
+    Starting a PoseEstimator loads the backend models, which takes seconds with
+    OpenPose, so estimators are created once up front and checked out by requests.
+    A request holds its estimator exclusively until it is checked back in.
+    """
+
+    def __init__(self, size=1, **estimator_args):
+        """
+        Args:
+            size: Number of estimators to create
+            estimator_args: Keyword arguments passed to every PoseEstimator
+        """
+        self.size = size
+        self._available = queue.Queue()
+        self._lock = threading.Lock()
+        self._checkouts = 0
+        self._wait_seconds = 0.0
+
+        start = time.perf_counter()
+        for _ in range(size):
+            self._available.put(PoseEstimator(**estimator_args))
+        self.warmup_seconds = time.perf_counter() - start
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """Borrows an estimator for the duration of a with block.
+
+        Args:
+            timeout: Seconds to wait for a free estimator, forever if None
+
+        Raises:
+            queue.Empty if no estimator became free within timeout
+        """
+        start = time.perf_counter()
+        estimator = self._available.get(timeout = timeout)
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._checkouts += 1
+            self._wait_seconds += waited
+        profile = profiling.active()
+        if profile is not None:
+            profile.timings.add("pool.wait", waited)
+        try:
+            yield estimator
+        finally:
+            self._available.put(estimator)
+
+    def stats(self):
+        """
+        Returns:
+            A dictionary describing the pool for the health endpoint
+        """
+        available = self._available.qsize()
+        with self._lock:
+            return {
+                "size" : self.size,
+                "available" : available,
+                "in_use" : self.size - available,
+                "checkouts" : self._checkouts,
+                "avg_wait_seconds" : self._wait_seconds/self._checkouts if self._checkouts else 0.0,
+                "warmup_seconds" : self.warmup_seconds
+            }
@@ -0,0 +1,42 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# Number of files whose hash is remembered, uploads get fresh paths so old entries are dropped
+HASH_CACHE_SIZE = 256
+
+# Hashes of already seen files keyed by (path, size, mtime) so they are not re-read
+_hashes = OrderedDict()
+_hashes_lock = threading.Lock()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    '''
+    :param path: file to hash
+    :return: hex sha256 of the file contents
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_file_hash(path):
+    '''
+    file_hash memoized for as long as the file keeps its path, size and modification time,
+    for the HASH_CACHE_SIZE most recently hashed files
+    '''
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hashes_lock:
+        if memo_key in _hashes:
+            _hashes.move_to_end(memo_key)
+            return _hashes[memo_key]
+    digest = file_hash(path)
+    with _hashes_lock:
+        _hashes[memo_key] = digest
+        if len(_hashes) > HASH_CACHE_SIZE:
+            _hashes.popitem(last=False)
+    return digest
@@ -0,0 +1,190 @@
+from collections import namedtuple
+
+import numpy as np
+
+import cv2
+
+from DanceScorer import MIN_CONFIDENCE
+
+# Maps keypoints found on a prepared input back to the original frame: original = input/scale + (x, y)
+Crop = namedtuple("Crop", ["scale", "x", "y"])
+
+# Dancers closer than this fraction of the crop size to a side of the crop inside the frame may
+# reach past it, the next frame is then looked at whole
+_EDGE = 0.02
+
+# Frames are decoded at up to this many times the net resolution when cropping, so a dancer
+# filling half the frame still reaches the network at full net resolution
+_CROP_HEADROOM = 2
+
+
+def parse_resolution(resolution):
+    """
+    Args:
+        resolution: (width, height) or an OpenPose style "WIDTHxHEIGHT" string, -1 leaves a side free
+
+    Returns:
+        A (width, height) tuple of ints, or None if resolution is None
+    """
+    if resolution is None:
+        return None
+    if isinstance(resolution, str):
+        resolution = resolution.lower().split("x")
+    width, height = (int(side) for side in resolution)
+    if width <= 0 and height <= 0:
+        raise ValueError("Net resolution {}x{} needs at least one positive side".format(width, height))
+    return (width, height)
+
+
+def fit_scale(width, height, resolution):
+    """Largest scale, at most 1, at which a width x height image fits in resolution."""
+    if resolution is None:
+        return 1.0
+    scale = 1.0
+    if resolution[0] > 0:
+        scale = min(scale, resolution[0]/width)
+    if resolution[1] > 0:
+        scale = min(scale, resolution[1]/height)
+    return scale
+
+
+def downscale(image, size):
+    """Resizes an image to a smaller (width, height).
+
+    Area averaging is used for integer factors and factors of 2 and more, where it is
+    fast and free of aliasing, bilinear interpolation for the small factors in between
+    where area averaging is several times slower.
+    """
+    factor = image.shape[1]/size[0]
+    interpolation = cv2.INTER_AREA if factor >= 2 or factor.is_integer() else cv2.INTER_LINEAR
+    return cv2.resize(image, size, interpolation = interpolation)
+
+
+def restore_keypoints(keypoints, crop, people=1):
+    """Maps keypoints found on a prepared input to original frame coordinates.
+
+    Args:
+        keypoints: (people, 25, 3) keypoints in input coordinates, None or empty if nobody was found
+        crop: Crop the input was made with
+        people: Number of undetected people returned when nobody was found
+
+    Returns:
+        A float32 copy of keypoints, undetected keypoints stay at zero as OpenPose reports them
+    """
+    if keypoints is None or np.size(keypoints) == 0:
+        # OpenPose reports nobody found as None, which scores and crops like a dancer with no confident joints
+        return np.zeros(shape = (people, 25, 3), dtype = np.float32)
+    restored = np.array(keypoints, dtype = np.float32).reshape(-1, 25, 3)
+    detected = restored[..., 2] > 0
+    restored[..., 0] = np.where(detected, restored[..., 0]/crop.scale + crop.x, 0)
+    restored[..., 1] = np.where(detected, restored[..., 1]/crop.scale + crop.y, 0)
+    return restored
+
+
+class InputPreparer:
+    """Turns decoded frames into small inference inputs for one video.
+
+    Frames are cropped to the bounding box of the keypoints last found in the video,
+    grown by a margin, and downscaled to fit the net resolution. When fewer dancers
+    than expected were found, or they touch a side of the crop, the whole frame is
+    used next, so a limb or a dancer leaving the crop is not cut off for good. Keypoints found on the input are mapped back with restore_keypoints, and
+    handed to follow to move the crop along with the dancers.
+    """
+
+    def __init__(self, net_resolution=None, crop=True, margin=0.25, people=1, shrink=0.1, refresh=30):
+        """
+        Args:
+            net_resolution: (width, height) inputs are downscaled to fit, see parse_resolution, None keeps their size
+            crop: Crop to the dancers instead of using the whole frame
+            margin: Fraction of the keypoint bounding box added on every side of the crop
+            people: Number of dancers the crop has to hold
+            shrink: Fraction of the way the crop moves in towards the dancers every frame, it grows at once
+            refresh: The whole frame is looked at every refresh frames to find what the crop missed
+        """
+        self.net_resolution = parse_resolution(net_resolution)
+        self.crop = crop
+        self.margin = margin
+        self.people = people
+        self.shrink = shrink
+        self.refresh = refresh
+        self.reset()
+
+    def reset(self):
+        # Region of the original frame the dancers were last seen in, as (x0, y0, x1, y1)
+        self.box = None
+        # Sides of the last crop that were inside the frame, as (x0, y0, x1, y1) with None for frame borders
+        self._inner_sides = None
+        self._frames = 0
+
+    def decode_size(self, width, height):
+        """Size frames of a width x height video can be decoded at without losing inference detail.
+
+        Returns:
+            A (width, height) tuple, or None if frames should be kept at their size
+        """
+        if self.net_resolution is None:
+            return None
+        headroom = _CROP_HEADROOM if self.crop else 1
+        scale = fit_scale(width, height, tuple(side*headroom for side in self.net_resolution))
+        if scale >= 1.0:
+            return None
+        # Large reductions use the largest integer factor that keeps the needed resolution
+        if scale <= 0.5:
+            scale = 1/int(1/scale)
+        return (max(1, int(round(width*scale))), max(1, int(round(height*scale))))
+
+    def prepare(self, frame, frame_scale=1.0):
+        """
+        Args:
+            frame: Decoded BGR frame
+            frame_scale: Size of frame relative to the original video, below 1 for frames decoded at decode_size
+
+        Returns:
+            The inference input and the Crop mapping keypoints on it back to the original video
+        """
+        height, width = frame.shape[:2]
+        x0, y0, x1, y1 = 0, 0, width, height
+        self._frames += 1
+        if self.crop and self.box is not None and (not self.refresh or self._frames % self.refresh):
+            x0, y0, x1, y1 = (int(round(side*frame_scale)) for side in self.box)
+            x0, y0 = max(x0, 0), max(y0, 0)
+            x1, y1 = min(x1, width), min(y1, height)
+            if x1 - x0 < 2 or y1 - y0 < 2:
+                x0, y0, x1, y1 = 0, 0, width, height
+        self._inner_sides = (x0/frame_scale if x0 > 0 else None, y0/frame_scale if y0 > 0 else None,
+                             x1/frame_scale if x1 < width else None, y1/frame_scale if y1 < height else None)
+        image = frame[y0:y1, x0:x1]
+        scale = fit_scale(x1 - x0, y1 - y0, self.net_resolution)
+        if scale < 1.0:
+            size = (max(1, int(round((x1 - x0)*scale))), max(1, int(round((y1 - y0)*scale))))
+            image = downscale(image, size)
+            # The rounded size decides the real scale
+            scale = size[0]/(x1 - x0)
+        return image, Crop(scale*frame_scale, x0/frame_scale, y0/frame_scale)
+
+    def follow(self, keypoints):
+        """Moves the crop to the keypoints found on the last prepared frame, in original coordinates."""
+        if not self.crop:
+            return
+        keypoints = np.asarray(keypoints).reshape(-1, 25, 3)
+        confident = keypoints[..., 2] > MIN_CONFIDENCE
+        if np.count_nonzero(confident.sum(axis = 1) >= 2) < self.people:
+            self.box = None
+            return
+        points = keypoints[confident]
+        (x0, y0), (x1, y1) = points[:, :2].min(axis = 0), points[:, :2].max(axis = 0)
+        if self._inner_sides is not None:
+            left, top, right, bottom = self._inner_sides
+            edge = _EDGE*max((right or x1) - (left or x0), (bottom or y1) - (top or y0))
+            if ((left is not None and x0 - left < edge) or (top is not None and y0 - top < edge)
+                    or (right is not None and right - x1 < edge) or (bottom is not None and bottom - y1 < edge)):
+                self.box = None
+                return
+        pad = self.margin*max(x1 - x0, y1 - y0)
+        box = np.array((x0 - pad, y0 - pad, x1 + pad, y1 + pad))
+        if self.box is not None:
+            # Joints missed for a few frames stay inside the slowly shrinking crop and can be found again
+            old = np.array(self.box)
+            grown = np.concatenate((np.minimum(box[:2], old[:2]), np.maximum(box[2:], old[2:])))
+            box = np.where(grown == box, box, old + (box - old)*self.shrink)
+        self.box = tuple(box)
@@ -0,0 +1,215 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import profiling
+
+# Tracebacks of failed jobs go to the server log, clients only see the error message
+logger = logging.getLogger(__name__)
+
+
+def run_comparison(pose_estimator, workdir, teacher_path, student_path, render=True):
+    '''
+    Scores a student video against a teacher video and renders the output videos into workdir
+    :param pose_estimator: PoseEstimator checked out for this comparison
+    :param workdir: directory the output videos are written to
+    :param teacher_path: path to the teacher video
+    :param student_path: path to the student video
+    :param render: render the overlays and the wireframe, only the scores are computed if False
+    :return: scores, dictionary of output video paths, empty if nothing was rendered
+    '''
+    if not render:
+        return pose_estimator.compare_videos(student_path, teacher_path), {}
+    outputs = {
+        "student_overlay" : os.path.join(workdir, "student-overlay.mp4"),
+        "teacher_overlay" : os.path.join(workdir, "master-overlay.mp4"),
+        "wireframe" : os.path.join(workdir, "black-wireframe.mp4")
+    }
+    if pose_estimator.encoder is not None:
+        # Score first, then render all three videos at once on the encoder's process pool
+        scores = pose_estimator.compare_videos(student_path, teacher_path)
+        pose_estimator.encode_outputs(skeleton_out1=outputs["student_overlay"],
+                                      skeleton_out2=outputs["teacher_overlay"],
+                                      wireframe_out=outputs["wireframe"])
+        return scores, outputs
+    scores = pose_estimator.compare_videos(student_path, teacher_path,
+                                           write_skeleton=True,
+                                           skeleton_out1=outputs["student_overlay"],
+                                           skeleton_out2=outputs["teacher_overlay"])
+    pose_estimator.get_wireframe(outputs["wireframe"])
+    return scores, outputs
+
+
+def save_upload(upload, workdir, name):
+    '''
+    Saves an uploaded file into workdir, keeping its extension so the decoder can pick the container
+    :return: path of the saved file
+    '''
+    extension = os.path.splitext(upload.filename or "")[1] or ".mp4"
+    path = os.path.join(workdir, name + extension)
+    upload.save(path)
+    return path
+
+
+class QueueFull(Exception):
+    """Raised by JobManager.submit when too many jobs are waiting to run."""
+    pass
+
+
+class Job:
+    """State of a single submitted comparison."""
+
+    def __init__(self, workdir, teacher_path, student_path, render=True):
+        self.id = uuid.uuid4().hex
+        self.workdir = workdir
+        self.teacher_path = teacher_path
+        self.student_path = student_path
+        self.render = render
+        self.status = "queued"
+        self.scores = None
+        self.outputs = None
+        self.error = None
+        # Profile of the run as a dictionary, None if profiling is off
+        self.profile = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def as_dict(self):
+        return {
+            "job_id" : self.id,
+            "status" : self.status,
+            "submitted" : self.submitted,
+            "started" : self.started,
+            "finished" : self.finished,
+            "error" : self.error
+        }
+
+
+class JobManager:
+    """Runs comparisons in the background so the HTTP layer only submits and polls.
+
+    Every job gets its own temporary directory for the uploaded videos and the
+    rendered outputs, so concurrent jobs never overwrite each other's files.
+    Workers check PoseEstimators out of an EstimatorPool for the duration of a job.
+    Finished jobs are evicted with their directories once they are older than ttl
+    or more than max_finished of them are kept, oldest first, whether or not the
+    client deleted them.
+    """
+
+    def __init__(self, pool, workers=None, profile=True, max_queued=64, max_finished=256, ttl=3600):
+        """
+        Args:
+            pool: EstimatorPool the jobs borrow estimators from
+            workers: Number of jobs run concurrently, defaults to the pool size
+            profile: Record stage timings, counters and peaks of every job, see profiling
+            max_queued: Number of jobs allowed to wait for a worker, submit raises QueueFull beyond it
+            max_finished: Number of finished jobs kept for their clients to fetch
+            ttl: Seconds a finished job is kept after it finished
+        """
+        self.pool = pool
+        self.profile = profile
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers = workers or pool.size)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create_workdir(self):
+        return tempfile.mkdtemp(prefix = "deepdance-job-")
+
+    def submit(self, teacher, student, render=True):
+        """Stores the uploaded videos in a fresh job directory and queues the comparison.
+
+        Args:
+            teacher: Uploaded teacher video (anything with filename and save())
+            student: Uploaded student video
+            render: Render the output videos, False when only the scores are wanted
+
+        Returns:
+            The queued Job
+
+        Raises:
+            QueueFull if max_queued jobs are already waiting
+        """
+        self.evict()
+        with self._lock:
+            queued = sum(1 for job in self._jobs.values() if job.status == "queued")
+        if queued >= self.max_queued:
+            raise QueueFull("{} jobs are already waiting".format(queued))
+        workdir = self.create_workdir()
+        job = Job(workdir, save_upload(teacher, workdir, "master"), save_upload(student, workdir, "student"), render)
+        with self._lock:
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        job.status = "running"
+        job.started = time.time()
+        profile = profiling.Profile() if self.profile else None
+        try:
+            with profiling.profiling(profile), self.pool.checkout() as pose_estimator, profiling.stage("job.run"):
+                job.scores, job.outputs = run_comparison(pose_estimator, job.workdir, job.teacher_path, job.student_path,
+                                                             job.render)
+            job.status = "done"
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            if profile is not None:
+                profile.count("jobs." + job.status)
+                job.profile = profile.as_dict()
+                profiling.totals.merge(profile)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def delete(self, job_id):
+        """Forgets a finished job and removes its directory.
+
+        Returns:
+            False if the job does not exist or is still queued or running
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status not in ("done", "failed"):
+                return False
+            del self._jobs[job_id]
+        shutil.rmtree(job.workdir, ignore_errors = True)
+        return True
+
+    def evict(self):
+        """Removes finished jobs past their ttl and the oldest ones beyond max_finished.
+
+        Returns:
+            Number of jobs removed
+        """
+        now = time.time()
+        with self._lock:
+            finished = sorted((job for job in self._jobs.values() if job.finished is not None),
+                              key = lambda job: job.finished)
+            expired = [job for job in finished if now - job.finished > self.ttl]
+            kept = finished[len(expired):]
+            expired += kept[:max(0, len(kept) - self.max_finished)]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            shutil.rmtree(job.workdir, ignore_errors = True)
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
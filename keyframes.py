@@ -0,0 +1,148 @@
+import numpy as np
+
+import cv2
+
+from DanceScorer import MIN_CONFIDENCE
+
+# Width of the grayscale thumbnails frames are compared on, enough to see a dancer move
+_THUMBNAIL_WIDTH = 64
+
+INTERPOLATIONS = ("linear", "spline")
+
+# Longest gap between keyframes when only a motion threshold is given, a third of a second at 30 fps
+MOTION_MAX_GAP = 10
+
+
+class KeyframeSelector:
+    """Decides which frames of a video go through pose estimation.
+
+    Without a motion threshold every interval-th frame is a keyframe. With one, a frame
+    becomes a keyframe when the mean absolute difference between its thumbnail and the
+    thumbnail of the last keyframe exceeds the threshold, and interval is the longest
+    gap allowed between keyframes. The first frame is always a keyframe.
+    """
+
+    def __init__(self, interval=1, motion_threshold=None):
+        """
+        Args:
+            interval: Frames per keyframe, or the longest gap between keyframes with a motion threshold
+            motion_threshold: Mean absolute gray level difference, from 0 to 255, that triggers a keyframe
+        """
+        self.interval = max(1, int(interval))
+        self.motion_threshold = motion_threshold
+        self.reset()
+
+    @property
+    def subsampling(self):
+        return self.interval > 1
+
+    def reset(self):
+        self._since_key = None
+        self._last_thumbnail = None
+
+    def _thumbnail(self, frame):
+        height, width = frame.shape[:2]
+        size = (_THUMBNAIL_WIDTH, max(1, int(round(height*_THUMBNAIL_WIDTH/width))))
+        small = cv2.resize(frame, size, interpolation = cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small
+
+    def select(self, frame):
+        """Tells whether the next frame of the video is a keyframe.
+
+        Args:
+            frame: The next BGR or grayscale frame, only looked at with a motion threshold
+        """
+        if self._since_key is not None and self._since_key + 1 < self.interval:
+            if self.motion_threshold is None:
+                self._since_key += 1
+                return False
+            thumbnail = self._thumbnail(frame)
+            if cv2.absdiff(thumbnail, self._last_thumbnail).mean() <= self.motion_threshold:
+                self._since_key += 1
+                return False
+            self._last_thumbnail = thumbnail
+        elif self.motion_threshold is not None:
+            self._last_thumbnail = self._thumbnail(frame)
+        self._since_key = 0
+        return True
+
+
+def _hermite_tangents(knots, times, confident):
+    """Tangents in pixels per frame at every knot, from the neighbouring confident knots.
+
+    Knots with confident neighbours on both sides get the slope between those neighbours,
+    knots with one get the slope towards it and the others a zero tangent.
+    """
+    gaps = np.diff(times).reshape((-1,) + (1,)*(knots.ndim - 1))
+    steps = np.diff(knots, axis = 0)/gaps
+    step_valid = (confident[1:] & confident[:-1])[..., None]
+
+    pad = np.zeros(shape = (1,) + steps.shape[1:])
+    prev_steps, next_steps = np.concatenate((pad, steps)), np.concatenate((steps, pad))
+    prev_valid = np.concatenate((np.zeros(shape = (1,) + step_valid.shape[1:], dtype = bool), step_valid))
+    next_valid = np.concatenate((step_valid, np.zeros(shape = (1,) + step_valid.shape[1:], dtype = bool)))
+    prev_gaps = np.concatenate((np.ones(shape = (1,) + gaps.shape[1:]), gaps))
+    next_gaps = np.concatenate((gaps, np.ones(shape = (1,) + gaps.shape[1:])))
+
+    central = (prev_steps*prev_gaps + next_steps*next_gaps)/(prev_gaps + next_gaps)
+    return np.where(prev_valid & next_valid, central,
+                    np.where(prev_valid, prev_steps, np.where(next_valid, next_steps, 0)))
+
+
+def interpolate_keypoints(poses, keyframes, method="linear"):
+    """Fills the frames between keyframes from the keyframes around them.
+
+    A joint is interpolated only where it is confident in both surrounding keyframes,
+    its confidence then goes linearly from one to the other. Where either keyframe
+    missed the joint it gets zero confidence in between, so scoring ignores it rather
+    than comparing a guess. Frames after the last keyframe repeat it.
+
+    Args:
+        poses: (N, ..., 25, 3) keypoints, only the rows of keyframes are read
+        keyframes: Boolean array of length N marking the frames that went through pose estimation
+        method: "linear", or "spline" for a cubic Hermite curve through the keyframes
+
+    Returns:
+        A float32 array shaped like poses with the keyframes unchanged
+    """
+    if method not in INTERPOLATIONS:
+        raise ValueError("Unknown interpolation {}, expected one of {}".format(method, INTERPOLATIONS))
+    poses = np.asarray(poses, dtype = np.float32)
+    keys = np.flatnonzero(keyframes)
+    filled = poses.copy()
+    if len(keys) == 0 or len(keys) == len(poses):
+        return filled
+
+    frames = np.arange(len(poses))
+    # Index of the keyframe at or before every frame, frames before the first one use it
+    left = np.clip(np.searchsorted(keys, frames, side = "right") - 1, 0, len(keys) - 1)
+    right = np.minimum(left + 1, len(keys) - 1)
+    between = (frames > keys[left]) & (left < len(keys) - 1)
+    held = ~np.isin(frames, keys) & ~between
+
+    filled[held] = poses[keys[left[held]]]
+
+    targets = frames[between]
+    a, b = left[between], right[between]
+    span = (keys[b] - keys[a]).astype(np.float64)
+    t = ((targets - keys[a])/span).reshape((-1,) + (1,)*(poses.ndim - 1))
+
+    knots = poses[keys].astype(np.float64)
+    confident = knots[..., 2] > MIN_CONFIDENCE
+    both = (confident[a] & confident[b])[..., None]
+
+    if method == "linear":
+        points = knots[a, ..., :2]*(1 - t) + knots[b, ..., :2]*t
+    else:
+        tangents = _hermite_tangents(knots[..., :2], keys.astype(np.float64), confident)
+        t2, t3 = t*t, t*t*t
+        span = span.reshape(t.shape)
+        points = ((2*t3 - 3*t2 + 1)*knots[a, ..., :2] + (t3 - 2*t2 + t)*span*tangents[a]
+                  + (-2*t3 + 3*t2)*knots[b, ..., :2] + (t3 - t2)*span*tangents[b])
+    confidence = knots[a, ..., 2:]*(1 - t) + knots[b, ..., 2:]*t
+
+    filled[targets, ..., :2] = np.where(both, points, 0)
+    filled[targets, ..., 2:] = np.where(both, confidence, 0)
+    return filled
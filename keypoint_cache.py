@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+
+import profiling
+from file_hashing import cached_file_hash
+
+
+class KeypointCache:
+    """Content-addressed on-disk cache of per-video keypoint arrays.
+
+    Entries are keyed by the hash of the video file together with the pose backend
+    and its parameters, so the same teacher video uploaded again maps to the same
+    entry no matter where it was saved. Entries are plain .npy files loaded with
+    mmap, and the least recently used ones are evicted once the cache grows past
+    max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        """
+        Args:
+            directory: Directory holding the cached .npy files, created if missing
+            max_bytes: Total size the cache is trimmed back to after every write
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok = True)
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, video_path, backend, params):
+        '''
+        :param video_path: path to the video the keypoints belong to
+        :param backend: name of the pose backend
+        :param params: backend parameters, e.g. number_people_max and model_folder
+        :return: hex cache key
+        '''
+        description = json.dumps({"video" : cached_file_hash(video_path), "backend" : backend, "params" : params},
+                                 sort_keys = True, default = str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        '''
+        :return: read-only memory-mapped keypoint array, or None on a miss
+        '''
+        path = self._path(key)
+        try:
+            keypoints = np.load(path, mmap_mode = "r")
+            # Touch the entry so eviction sees it as recently used
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            profiling.count("keypoint_cache.misses")
+            return None
+        with self._lock:
+            self.hits += 1
+        profiling.count("keypoint_cache.hits")
+        return keypoints
+
+    def put(self, key, keypoints):
+        '''
+        stores an (N, people, 25, 3) keypoint array and evicts old entries if needed
+        '''
+        path = self._path(key)
+        # Write to a temporary name first so readers never see a partial file
+        tmp_path = "{}.{}.tmp.npy".format(path[:-4], uuid.uuid4().hex)
+        np.save(tmp_path, np.asarray(keypoints, dtype = np.float32))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        '''
+        deletes least recently used entries until the cache fits in max_bytes
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy") and ".tmp." not in name:
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return {"hits" : self.hits, "misses" : self.misses}
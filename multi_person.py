@@ -0,0 +1,229 @@
+import warnings
+
+import numpy as np
+
+from DanceScorer import MIN_CONFIDENCE, DanceScorer, calc_joint_angles
+from pose_buffer import PoseBuffer
+import profiling
+
+# Cost of giving a detection to a slot that has not been seen yet, larger than any pixel distance
+_NEW_SLOT_COST = 1e9
+
+
+def pad_people(keypoints, people):
+    """Brings the keypoints of one frame to a fixed number of people.
+
+    Args:
+        keypoints: (K, 25, 3) detections of a frame, None or an empty array if nobody was found
+        people: Number of people P to return
+
+    Returns:
+        A float32 array of shape (P, 25, 3), the K most confident detections followed by
+        zero confidence people
+    """
+    padded = np.zeros(shape = (people, 25, 3), dtype = np.float32)
+    if keypoints is None or np.ndim(keypoints) < 3:
+        return padded
+    keypoints = np.asarray(keypoints, dtype = np.float32).reshape(-1, 25, 3)
+    if len(keypoints) > people:
+        keypoints = keypoints[np.argsort(-keypoints[:, :, 2].sum(axis = 1), kind = "stable")[:people]]
+    padded[:len(keypoints)] = keypoints
+    return padded
+
+
+def centroids(poses):
+    """Mean position of the confident keypoints of every person.
+
+    Args:
+        poses: An (..., 25, 3) keypoint array
+
+    Returns:
+        An (..., 2) array, NaN for people without any confident keypoint
+    """
+    confident = poses[..., 2] > MIN_CONFIDENCE
+    counts = confident.sum(axis = -1)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        return np.where(counts[..., None] > 0,
+                        (poses[..., 0:2]*confident[..., None]).sum(axis = -2)/counts[..., None], np.nan)
+
+
+class PersonTracker:
+    """Keeps person IDs consistent from frame to frame.
+
+    Every frame the detections are assigned to slots with the Hungarian algorithm on the
+    distances between their centroids and the last centroid seen in every slot. Slots
+    keep their last centroid while their person is not detected, so a dancer that is
+    briefly occluded gets their slot back. On the first frame the slots are filled left
+    to right.
+    """
+
+    def __init__(self, people):
+        """
+        Args:
+            people: Number of slots P
+        """
+        # Imported here so single person use does not pay for loading scipy
+        from scipy.optimize import linear_sum_assignment
+
+        self._assign = linear_sum_assignment
+        self.people = people
+        self.reset()
+
+    def reset(self):
+        self.last = np.full(shape = (self.people, 2), fill_value = np.nan)
+
+    def update(self, keypoints):
+        """Assigns the detections of the next frame to slots.
+
+        Args:
+            keypoints: (K, 25, 3) detections of the frame in any order
+
+        Returns:
+            A (P, 25, 3) float32 array with the person of every slot, zero confidence for empty slots
+        """
+        detections = pad_people(keypoints, self.people)
+        positions = centroids(detections)
+        found = np.flatnonzero(~np.isnan(positions[:, 0]))
+        tracked = np.zeros(shape = detections.shape, dtype = np.float32)
+        if len(found) == 0:
+            return tracked
+
+        known = ~np.isnan(self.last[:, 0])
+        if not known.any():
+            slots = np.arange(len(found))
+            order = found[np.argsort(positions[found, 0], kind = "stable")]
+        else:
+            cost = np.linalg.norm(self.last[:, None, :] - positions[None, found, :], axis = -1)
+            cost[~known] = _NEW_SLOT_COST
+            slots, columns = self._assign(cost)
+            order = found[columns]
+        tracked[slots] = detections[order]
+        self.last[slots] = positions[order]
+        return tracked
+
+    def track(self, poses):
+        """Tracks a whole sequence.
+
+        Args:
+            poses: (N, K, 25, 3) detections
+
+        Returns:
+            An (N, P, 25, 3) float32 array
+        """
+        self.reset()
+        return np.array([self.update(frame) for frame in poses], dtype = np.float32).reshape(-1, self.people, 25, 3)
+
+
+def match_slots(student, teacher):
+    """Maps every student slot to the teacher slot in the same place of the formation.
+
+    The average position of every dancer is taken relative to the centre and spread of
+    their group, so the videos do not need the same framing.
+
+    Args:
+        student: (N, P, 25, 3) tracked student poses
+        teacher: (M, P, 25, 3) tracked teacher poses
+
+    Returns:
+        An int array of length P with the teacher slot of every student slot
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    def formation(poses):
+        with warnings.catch_warnings():
+            # nanmean warns about dancers that never appear, they are handled below
+            warnings.simplefilter("ignore", RuntimeWarning)
+            places = np.nanmean(centroids(poses), axis = 0)
+        seen = ~np.isnan(places[:, 0])
+        if not seen.any():
+            return np.zeros(shape = places.shape)
+        places = places - places[seen].mean(axis = 0)
+        spread = np.abs(places[seen]).max()
+        if spread > 0:
+            places = places/spread
+        # Dancers that never appear are placed far away so they take the leftover slots
+        return np.where(seen[:, None], places, _NEW_SLOT_COST)
+
+    student_places = formation(student)
+    teacher_places = formation(teacher)
+    cost = np.linalg.norm(student_places[:, None, :] - teacher_places[None, :, :], axis = -1)
+    slots, columns = linear_sum_assignment(np.minimum(cost, _NEW_SLOT_COST))
+    mapping = np.empty(len(slots), dtype = np.intp)
+    mapping[slots] = columns
+    return mapping
+
+
+def group_errors(student, teacher, mapping):
+    """Average joint angle errors of every student against their teacher in one pass.
+
+    Args:
+        student: (N, P, 25, 3) tracked student poses
+        teacher: (N, P, 25, 3) tracked teacher poses
+        mapping: Teacher slot of every student slot, from match_slots
+
+    Returns:
+        A (P, 10) float64 array, missing joints count as zero error like in score_dancer
+    """
+    frames, people = student.shape[:2]
+    student_angles = calc_joint_angles(student.reshape(-1, 25, 3)).reshape(frames, people, -1)
+    teacher_angles = calc_joint_angles(teacher[:, mapping].reshape(-1, 25, 3)).reshape(frames, people, -1)
+    valid = (student_angles != -1) & (teacher_angles != -1)
+    errors = np.where(valid, np.abs(student_angles - teacher_angles), 0)
+    return errors.mean(axis = 0, dtype = np.float64)
+
+
+class GroupScorer(DanceScorer):
+    """DanceScorer for routines with several dancers in each video.
+
+    The people of both videos are tracked into P slots as the frames come in, each
+    student is paired with the teacher in the same place of the formation, and all
+    pairs are scored at once on (N, P, 25, 3) arrays. Wireframes show every dancer.
+    """
+
+    def __init__(self, people):
+        """
+        Args:
+            people: Number of dancers P in each video
+        """
+        super().__init__()
+        self.people = people
+        self.poses = {
+            "student" : PoseBuffer(frame_shape = (people, 25, 3)),
+            "teacher" : PoseBuffer(frame_shape = (people, 25, 3))
+        }
+        self.trackers = {"student" : PersonTracker(people), "teacher" : PersonTracker(people)}
+
+    def add_frame_pose(self, student_pose, teacher_pose):
+        """Add the detections of a pair of frames, in any order and of any count."""
+        self.poses["student"].append(self.trackers["student"].update(student_pose))
+        self.poses["teacher"].append(self.trackers["teacher"].update(teacher_pose))
+
+    def use_reference(self, reference, start=0):
+        raise ValueError("Teacher references hold a single dancer and cannot be used for group routines")
+
+    @profiling.timed("score")
+    def score_dancer(self):
+        """Scores every student against their teacher.
+
+        Returns:
+            A dictionary with one entry per student slot in "dancers", holding the teacher
+            slot it was matched with and the scores of the pair laid out like
+            DanceScorer.score_dancer, and the mean of their averages in "average".
+            Students that never appear are left out.
+        """
+        frames = min(len(self.poses["student"]), len(self.poses["teacher"]))
+        student = self.poses["student"].view()[:frames]
+        teacher = self.poses["teacher"].view()[:frames]
+        mapping = match_slots(student, teacher)
+        errors = group_errors(student, teacher, mapping)
+
+        present = (student[..., 2] > MIN_CONFIDENCE).any(axis = (0, 2))
+        dancers = []
+        for slot in np.flatnonzero(present):
+            dancers.append({
+                "student" : int(slot),
+                "teacher" : int(mapping[slot]),
+                "scores" : self._scores_from_errors(errors[slot])
+            })
+        average = float(np.mean([dancer["scores"]["average"] for dancer in dancers])) if dancers else 0.0
+        return {"dancers" : dancers, "average" : average}
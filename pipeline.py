@@ -0,0 +1,192 @@
+import queue
+import threading
+import time
+
+import profiling
+from profiling import StageTimings
+
+# Marks the end of a stream on a stage queue
+_DONE = object()
+
+
+def _one(item):
+    return 1
+
+
+def batched(iterable, size):
+    """Groups the items of an iterable into lists of up to size items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class StagedPipeline:
+    """Runs decode, inference and encode as separate threads joined by bounded queues.
+
+    Every source iterator is drained by its own decode thread, a single inference
+    thread combines one item from each source and an encoder thread consumes the
+    results. Because the queues are bounded, a slow stage blocks the ones in front
+    of it (backpressure) so at most about `depth` items per queue are in memory.
+    The inference function always runs on one thread, which keeps backends that are
+    not thread safe (like the OpenPose wrapper) safe to use.
+    """
+
+    def __init__(self, depth=8, size=None, nbytes=None):
+        """
+        Args:
+            depth: Maximum number of items waiting in each queue
+            size: Function returning the number of frames in a source item, for batched sources
+            nbytes: Function returning the memory held by a source item, the peak held by the
+                pipeline is then recorded as the pipeline.frame_bytes peak of the active profile
+        """
+        self.depth = depth
+        self.size = size or _one
+        self.nbytes = nbytes
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self.timings = StageTimings()
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _guard(self, profile, target, *args):
+        try:
+            with profiling.profiling(profile):
+                target(*args)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def _track(self, items, sign):
+        # Source items are held from the moment they are decoded until the sink is done with them
+        if self.nbytes is None:
+            return
+        with self._in_flight_lock:
+            self._in_flight += sign*sum(self.nbytes(item) for item in items)
+            profiling.peak("pipeline.frame_bytes", self._in_flight)
+
+    def _decode(self, name, source, out_q):
+        source = iter(source)
+        while True:
+            start = time.perf_counter()
+            item = next(source, _DONE)
+            if item is _DONE:
+                break
+            self.timings.add(name, time.perf_counter() - start, self.size(item))
+            self._track((item,), 1)
+            if not self._put(out_q, item):
+                return
+        self._put(out_q, _DONE)
+
+    def _infer(self, infer, in_qs, out_q):
+        while True:
+            items = tuple(self._get(q) for q in in_qs)
+            # Stop as soon as any source is exhausted, like zip
+            if any(item is _DONE for item in items):
+                break
+            start = time.perf_counter()
+            result = infer(*items)
+            self.timings.add("inference", time.perf_counter() - start, min(self.size(item) for item in items))
+            if not self._put(out_q, (items, result)):
+                return
+        self._put(out_q, _DONE)
+
+    def _encode(self, sink, in_q):
+        while True:
+            entry = self._get(in_q)
+            if entry is _DONE:
+                break
+            start = time.perf_counter()
+            sink(*entry)
+            self.timings.add("encode", time.perf_counter() - start, min(self.size(item) for item in entry[0]))
+            self._track(entry[0], -1)
+
+    def run(self, sources, infer, sink):
+        """Runs the pipeline until the shortest source is exhausted.
+
+        Args:
+            sources: Iterables producing the input items, e.g. decoded frames of each video
+            infer: Called with one item from every source, returns the inference result
+            sink: Called with the tuple of source items and the inference result
+
+        Returns:
+            The stage timings as returned by StageTimings.as_dict
+        """
+        decode_qs = [queue.Queue(maxsize = self.depth) for _ in sources]
+        encode_q = queue.Queue(maxsize = self.depth)
+
+        # Stage threads record into the profile of the calling thread
+        profile = profiling.active()
+        threads = [threading.Thread(target = self._guard, args = (profile, self._decode, "decode{}".format(i + 1), source, q), daemon = True)
+                   for i, (source, q) in enumerate(zip(sources, decode_qs))]
+        threads.append(threading.Thread(target = self._guard, args = (profile, self._infer, infer, decode_qs, encode_q), daemon = True))
+        threads.append(threading.Thread(target = self._guard, args = (profile, self._encode, sink, encode_q), daemon = True))
+
+        for thread in threads:
+            thread.start()
+        # The encoder finishing means every item made it through, the decoders may
+        # still be blocked on a full queue of a longer source so release them
+        threads[-1].join()
+        self._stop.set()
+        for thread in threads[:-1]:
+            thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return self.timings.as_dict()
+
+
+def run_sequential(sources, infer, sink, size=None, nbytes=None):
+    """Runs the same stages as StagedPipeline one after another on the calling thread.
+
+    Args:
+        size: Function returning the number of frames in a source item, for batched sources
+        nbytes: Function returning the memory held by a source item, see StagedPipeline
+
+    Returns:
+        The stage timings as returned by StageTimings.as_dict
+    """
+    size = size or _one
+    timings = StageTimings()
+    sources = [iter(source) for source in sources]
+    while True:
+        items = []
+        for i, source in enumerate(sources):
+            start = time.perf_counter()
+            item = next(source, _DONE)
+            if item is _DONE:
+                return timings.as_dict()
+            timings.add("decode{}".format(i + 1), time.perf_counter() - start, size(item))
+            items.append(item)
+        items = tuple(items)
+        if nbytes is not None:
+            profiling.peak("pipeline.frame_bytes", sum(nbytes(item) for item in items))
+
+        start = time.perf_counter()
+        result = infer(*items)
+        timings.add("inference", time.perf_counter() - start, min(size(item) for item in items))
+
+        start = time.perf_counter()
+        sink(items, result)
+        timings.add("encode", time.perf_counter() - start, min(size(item) for item in items))
@@ -0,0 +1,212 @@
+import importlib
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from DanceScorer import draw_skeleton
+
+# Result of pose estimation on one frame, named like the op.Datum fields the rest of the code reads
+PoseDatum = namedtuple("PoseDatum", ["poseKeypoints", "cvOutputData"])
+
+
+class SkeletonDatum:
+    """Datum for keypoints that did not come from a backend run, e.g. cached ones.
+
+    The overlay in cvOutputData is drawn from the keypoints the first time it is read.
+    """
+
+    def __init__(self, poseKeypoints, image):
+        self.poseKeypoints = poseKeypoints
+        self.image = image
+        self._output = None
+
+    @property
+    def cvOutputData(self):
+        if self._output is None:
+            self._output = draw_skeleton(self.image.copy(), self.poseKeypoints, (0, 255, 0), thickness = 4)
+        return self._output
+
+# BODY_25 keypoints of a person standing with arms out, in units of body height centred on the mid hip
+_TEMPLATE = np.array([
+    [0.0, -0.45], [0.0, -0.35], [-0.1, -0.35], [-0.2, -0.25], [-0.3, -0.15],
+    [0.1, -0.35], [0.2, -0.25], [0.3, -0.15], [0.0, 0.0], [-0.07, 0.0],
+    [-0.08, 0.22], [-0.08, 0.45], [0.07, 0.0], [0.08, 0.22], [0.08, 0.45],
+    [-0.03, -0.47], [0.03, -0.47], [-0.06, -0.45], [0.06, -0.45], [0.12, 0.48],
+    [0.14, 0.47], [0.07, 0.47], [-0.12, 0.48], [-0.14, 0.47], [-0.07, 0.47]
+], dtype = np.float32)
+
+
+class PoseBackend:
+    """Interface of the pose estimation backends used by PoseEstimator.
+
+    A backend receives a batch of frames, possibly from different videos, and returns
+    one PoseDatum per frame in the same order. Batching lets a backend amortize its
+    per-call overhead over several frames.
+    """
+
+    # Name identifying the backend in cache keys
+    name = "base"
+
+    def __init__(self, params=None):
+        """
+        Args:
+            params: OpenPose style parameter dictionary, ignored by backends that do not need it
+        """
+        self.params = dict(params or {})
+
+    def reset(self):
+        """Called before a new pair of videos is processed, for backends that keep per-video state."""
+        pass
+
+    def estimate(self, frames, streams=None, positions=None):
+        """
+        Args:
+            frames: A list of BGR images
+            streams: Optional list with the index of the video every frame came from
+            positions: Optional list with the index of every frame among the frames of its video
+                since the last reset, given when frames are skipped, e.g. between keyframes
+
+        Returns:
+            A list with one PoseDatum per frame, poseKeypoints has shape (people, 25, 3)
+        """
+        raise NotImplementedError
+
+
+def _import_openpose():
+    try:
+        sys.path.append('/usr/local/python')
+        from openpose import pyopenpose as op
+    except ImportError as e:
+        print(
+            'Error: OpenPose library could not be found. Did you enable `BUILD_PYTHON` in CMake and have this Python script in the right folder?')
+        raise e
+    return op
+
+
+class OpenPoseBackend(PoseBackend):
+    """Adapter running batches of frames through the OpenPose python wrapper."""
+
+    name = "openpose"
+
+    def __init__(self, params=None):
+        super().__init__(params)
+        self.op = _import_openpose()
+        self.opWrapper = self.op.WrapperPython()
+        self.opWrapper.configure(self.params)
+        self.opWrapper.start()
+
+    def estimate(self, frames, streams=None, positions=None):
+        datums = []
+        for frame in frames:
+            datum = self.op.Datum()
+            datum.cvInputData = frame
+            datums.append(datum)
+        # OpenPose processes every datum of the vector in a single call
+        self.opWrapper.emplaceAndPop(datums)
+        return datums
+
+
+class ReplayBackend(PoseBackend):
+    """Replays precomputed keypoints, e.g. the arrays saved in numpyfiles/.
+
+    Each video (stream) has its own .npy file of shape (N, 1, 25, 3) and its own
+    cursor, frames past the end of a file get a pose with zero confidence. When
+    positions are given they are used instead of the cursor, so skipped frames
+    are skipped in the file too.
+    """
+
+    name = "replay"
+
+    def __init__(self, params=None, keypoints=()):
+        """
+        Args:
+            keypoints: One .npy path or array per stream, in the order the videos are passed
+        """
+        super().__init__(params)
+        self.keypoints = [np.load(k, mmap_mode = "r") if isinstance(k, str) else np.asarray(k) for k in keypoints]
+        self.cursors = [0]*len(self.keypoints)
+
+    def reset(self):
+        self.cursors = [0]*len(self.keypoints)
+
+    def estimate(self, frames, streams=None, positions=None):
+        if streams is None:
+            streams = [0]*len(frames)
+        if positions is None:
+            positions = [None]*len(frames)
+        datums = []
+        for frame, stream, position in zip(frames, streams, positions):
+            keypoints = self.keypoints[stream]
+            index = self.cursors[stream] if position is None else position
+            self.cursors[stream] = index + 1
+            if index < len(keypoints):
+                pose = np.array(keypoints[index], dtype = np.float32).reshape(-1, 25, 3)
+            else:
+                pose = np.zeros(shape = (1, 25, 3), dtype = np.float32)
+            datums.append(PoseDatum(pose, frame))
+        return datums
+
+
+class StubBackend(PoseBackend):
+    """Deterministic CPU backend for tests and benchmarks without OpenPose.
+
+    Places a fixed skeleton at the intensity-weighted centroid of every frame and
+    bends the arms with its mean brightness, so identical frames give identical
+    keypoints and changing frames give moving skeletons.
+    """
+
+    name = "synthetic"
+
+    def estimate(self, frames, streams=None, positions=None):
+        return [PoseDatum(self._keypoints(frame), frame) for frame in frames]
+
+    def _keypoints(self, frame):
+        height, width = frame.shape[:2]
+        gray = frame.reshape(height, width, -1).mean(axis = 2, dtype = np.float32)
+        total = gray.sum()
+        if total > 0:
+            cx = (gray.sum(axis = 0) @ np.arange(width, dtype = np.float32))/total
+            cy = (gray.sum(axis = 1) @ np.arange(height, dtype = np.float32))/total
+        else:
+            cx, cy = width/2, height/2
+
+        points = _TEMPLATE*height*0.8
+        # Raise the wrists with the brightness of the frame
+        points[[4, 7], 1] -= gray.mean()/255*0.3*height
+
+        keypoints = np.empty(shape = (1, 25, 3), dtype = np.float32)
+        keypoints[0, :, 0] = cx + points[:, 0]
+        keypoints[0, :, 1] = cy + points[:, 1]
+        keypoints[0, :, 2] = 0.9
+        return keypoints
+
+
+# Registered backends as name -> "module:Class", modules are only imported when a backend is created
+BACKENDS = {
+    "openpose" : "pose_backends:OpenPoseBackend",
+    "replay" : "pose_backends:ReplayBackend",
+    "synthetic" : "pose_backends:StubBackend"
+}
+
+
+def register_backend(name, path):
+    """Registers a backend class given as "module:Class" under name."""
+    BACKENDS[name] = path
+
+
+def create_backend(name, params=None, **options):
+    """Imports and instantiates a registered backend.
+
+    Args:
+        name: Key of the backend in BACKENDS
+        params: OpenPose style parameter dictionary passed to the backend
+        options: Extra keyword arguments for the backend constructor
+
+    Returns:
+        A PoseBackend instance
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown pose backend '{}', expected one of {}".format(name, sorted(BACKENDS)))
+    module, cls = BACKENDS[name].split(":")
+    return getattr(importlib.import_module(module), cls)(params, **options)
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+class PoseBuffer:
+    """Growable array-backed store for a sequence of frame poses.
+
+    Frames are written into a single preallocated array whose capacity
+    doubles when it fills up, so appending is amortized O(1) and no separate
+    object is kept alive per frame. The stored frames are always available as one
+    contiguous (N, *frame_shape) view.
+    """
+
+    def __init__(self, frame_shape=(1, 25, 3), capacity=1024, dtype=np.float32):
+        """
+        Args:
+            frame_shape: Shape of a single frame pose, (people, keypoints, 3) for OpenPose
+            capacity: Number of frames to preallocate room for
+            dtype: Element type, float32 unless the buffer holds something other than poses
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self._data = np.zeros(shape = (max(capacity, 1),) + self.frame_shape, dtype = self.dtype)
+        self._length = 0
+
+    @classmethod
+    def from_array(cls, poses):
+        """Creates a buffer holding a copy of an (N, *frame_shape) array."""
+        poses = np.asarray(poses, dtype = np.float32)
+        buffer = cls(frame_shape = poses.shape[1:], capacity = poses.shape[0])
+        buffer.extend(poses)
+        return buffer
+
+    @classmethod
+    def load(cls, fname):
+        """Loads a buffer from a .npy file of stacked frame poses."""
+        return cls.from_array(np.load(fname))
+
+    def save(self, fname):
+        """Saves the stored frames to a .npy file."""
+        np.save(fname, self.view())
+
+    def _reserve(self, length):
+        if length <= self._data.shape[0]:
+            return
+        capacity = max(length, 2*self._data.shape[0])
+        data = np.zeros(shape = (capacity,) + self.frame_shape, dtype = self.dtype)
+        data[:self._length] = self._data[:self._length]
+        self._data = data
+
+    def append(self, pose):
+        """Appends the pose of a single frame."""
+        self._reserve(self._length + 1)
+        self._data[self._length] = pose
+        self._length += 1
+
+    def extend(self, poses):
+        """Appends an (N, *frame_shape) array of frame poses."""
+        poses = np.asarray(poses, dtype = self.dtype).reshape((-1,) + self.frame_shape)
+        self._reserve(self._length + poses.shape[0])
+        self._data[self._length:self._length + poses.shape[0]] = poses
+        self._length += poses.shape[0]
+
+    def clear(self):
+        """Drops all frames, keeping the allocated capacity."""
+        self._length = 0
+
+    def view(self):
+        """Returns a contiguous (N, *frame_shape) view of the stored frames.
+
+        The view is only valid until the next append that grows the buffer.
+        """
+        return self._data[:self._length]
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        return self.view()[index]
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __array__(self, dtype = None, copy = None):
+        if dtype is None or np.dtype(dtype) == self.dtype:
+            return self.view().copy() if copy else self.view()
+        return self.view().astype(dtype)
@@ -1,44 +1,212 @@
 # From Python
 # It requires OpenCV installed for Python
-import sys
+import os
 import cv2
+import numpy as np
 from tqdm import tqdm
 from DanceScorer import DanceScorer
-from alignment import align, check_alignment
+from multi_person import GroupScorer
+from keyframes import INTERPOLATIONS, MOTION_MAX_GAP, KeyframeSelector, interpolate_keypoints
+from input_preparation import InputPreparer, downscale, parse_resolution, restore_keypoints
+from alignment import open_aligned, iter_frames, open_writer, combined_shape, combine_frames
+from pipeline import StagedPipeline, run_sequential, batched
+from pose_backends import PoseBackend, SkeletonDatum, create_backend
+import profiling
+from time_warp import score_dancer_warped
+
+def _batch_bytes(frames):
+    return sum(frame.nbytes for frame in frames)
 
-try:
-    sys.path.append('/usr/local/python')
-    from openpose import pyopenpose as op
-except ImportError as e:
-    print(
-        'Error: OpenPose library could not be found. Did you enable `BUILD_PYTHON` in CMake and have this Python script in the right folder?')
-    raise e
 
 class PoseEstimator:
-    def __init__(self):
+    def __init__(self, backend=None, batch_size=4, threaded=True, queue_depth=8, backend_options=None,
+                 keypoint_cache=None, auto_align=True, warp_scores=False, warp_band=60, encoder=None, people=1,
+                 keyframe_interval=1, motion_threshold=None, interpolation="linear",
+                 net_resolution=None, crop_to_dancer=False, crop_margin=0.25):
+        '''
+        :param backend: PoseBackend or registered backend name, DEEPDANCE_BACKEND (default openpose) if None
+        :param backend_options: extra keyword arguments for a backend created by name
+        :param keypoint_cache: KeypointCache used by compare_videos to skip inference on known videos
+        :param auto_align: shift the videos in compare_videos by the offset found in their audio
+        :param warp_scores: also report scores after time-warping the student onto the teacher, single dancer only
+        :param warp_band: half width in frames of the band the time warp may deviate from the global offset
+        :param people: number of dancers in each video, more than one tracks and scores every dancer with GroupScorer
+        :param keyframe_interval: run inference on every keyframe_interval-th frame of compare_videos and interpolate
+                                  the keypoints in between, with a motion threshold the longest gap between keyframes,
+                                  MOTION_MAX_GAP if a motion threshold is given without one
+        :param motion_threshold: mean gray level change since the last keyframe, from 0 to 255, that makes a frame a keyframe
+        :param interpolation: "linear" or "spline" interpolation of the keypoints between keyframes
+        :param net_resolution: (width, height) or "WIDTHxHEIGHT" the backend input is downscaled to fit, -1 leaves a
+                               side free, also passed to OpenPose
+        :param crop_to_dancer: crop the backend input to the dancers found in the previous frames
+        :param crop_margin: fraction of the dancers' bounding box added on every side of the crop
+        :param encoder: VideoEncoder used by encode_outputs to render output videos on a process pool
+        :param batch_size: number of frame pairs sent to the backend per call in compare_videos
+        :param threaded: run decode, inference and encode of compare_videos on separate threads
+        :param queue_depth: number of batches buffered between pipeline stages when threaded
+        '''
+        # Checked before the backend is started, not after a whole inference run
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError("Unknown interpolation {}, expected one of {}".format(interpolation, INTERPOLATIONS))
+
         # parameters for pose estimation
         self.params = dict()
         self.params["model_folder"] = "models/"
         self.params["face"] = False
         self.params["hand"] = False
-        self.params["number_people_max"] = 1
+        self.params["number_people_max"] = people
+        net_resolution = parse_resolution(net_resolution)
+        if net_resolution is not None:
+            self.params["net_resolution"] = "{}x{}".format(*net_resolution)
         # self.params["num_gpu"] = op.get_gpu_number()
 
-        # Starting OpenPose
-        self.opWrapper = op.WrapperPython()
-        self.opWrapper.configure(self.params)
-        self.opWrapper.start()
+        # Starting the pose backend, OpenPose is only imported if it is selected
+        if backend is None:
+            backend = os.environ.get("DEEPDANCE_BACKEND", "openpose")
+        if not isinstance(backend, PoseBackend):
+            backend = create_backend(backend, self.params, **(backend_options or {}))
+        self.backend = backend
+
+        self.people = people
+        self.dance_scorer = self.new_scorer()
+
+        self.batch_size = batch_size
+        self.threaded = threaded
+        self.queue_depth = queue_depth
+        # Per-stage busy time and frame rate of the last compare_videos call
+        self.stage_timings = {}
+
+        self.keypoint_cache = keypoint_cache
+        self.auto_align = auto_align
+        self.warp_scores = warp_scores
+        self.warp_band = warp_band
+        self.encoder = encoder
+        # Source videos, first aligned frames, fps and shapes of the last compare_videos call
+        self.last_comparison = None
+        # Cached keypoints of both videos of the current comparison and the next frame index of each
+        self._cached = [None, None]
+        self._positions = [0, 0]
+        if motion_threshold is not None and keyframe_interval <= 1:
+            keyframe_interval = MOTION_MAX_GAP
+        self.keyframe_interval = keyframe_interval
+        self.motion_threshold = motion_threshold
+        self.interpolation = interpolation
+        # Keyframe selectors of both videos during compare_videos, None when every frame is estimated
+        self._selectors = [None, None]
+        # Whether every frame of both videos was estimated, and the keypoints of the last keyframe
+        self._keyframes = [[], []]
+        self._held = [None, None]
+        # Input preparation of both videos, None when the backend gets the decoded frames as they are
+        self.preparers = None
+        if net_resolution is not None or crop_to_dancer:
+            self.preparers = [InputPreparer(net_resolution, crop_to_dancer, crop_margin, people) for _ in range(2)]
+        self.crop_margin = crop_margin if crop_to_dancer else None
+        # Size of the decoded frames of both videos relative to the original ones, and their (width, height)
+        self._frame_scales = [1.0, 1.0]
+        self._decode_sizes = [None, None]
+
+    @property
+    def subsampling(self):
+        return self.keyframe_interval > 1
+
+    def new_scorer(self):
+        if self.people > 1:
+            return GroupScorer(self.people)
+        return DanceScorer()
+
+    def _hold_keyframes(self, datums, images, count):
+        '''
+        Records which frames of the batch were estimated and gives the skipped ones the keypoints of
+        the last keyframe, which the overlays show and which are interpolated before scoring
+        '''
+        for stream in range(2):
+            for k in range(count):
+                datum = datums[stream][k]
+                self._keyframes[stream].append(datum is not None)
+                if datum is None:
+                    datums[stream][k] = SkeletonDatum(self._held[stream], images[stream][k])
+                else:
+                    self._held[stream] = datum.poseKeypoints
+
+    def interpolate_skipped(self):
+        '''
+        Replaces the held keypoints of the frames skipped by compare_videos with keypoints
+        interpolated between the keyframes around them
+        '''
+        for dancer, keyframes in zip(("student", "teacher"), self._keyframes):
+            poses = self.dance_scorer.poses[dancer].view()
+            poses[:] = interpolate_keypoints(poses, np.array(keyframes[:len(poses)], dtype=bool), self.interpolation)
+
+    @property
+    def cache_params(self):
+        '''
+        backend parameters and the input preparation settings that change the keypoints, used in cache keys
+        '''
+        if self.crop_margin is None:
+            return self.params
+        return dict(self.params, crop_margin=self.crop_margin)
+
+    def _estimate(self, frames, streams, positions=None):
+        '''
+        Runs the backend on frames of both videos, prepared and mapped back to the original
+        video coordinates if there are preparers
+        '''
+        options = {} if positions is None else {"positions": positions}
+        if self.preparers is None:
+            return self.backend.estimate(frames, streams=streams, **options)
+
+        inputs, crops = [], []
+        for frame, stream in zip(frames, streams):
+            image, crop = self.preparers[stream].prepare(frame, self._frame_scales[stream])
+            inputs.append(image)
+            crops.append(crop)
+        profiling.count("input.pixels", sum(image.shape[0]*image.shape[1] for image in inputs))
+        datums = []
+        for frame, stream, crop, datum in zip(frames, streams, crops, self.backend.estimate(inputs, streams=streams, **options)):
+            keypoints = restore_keypoints(datum.poseKeypoints, crop, self.people)
+            self.preparers[stream].follow(keypoints)
+            # The overlay is drawn on the decoded frame, not on the input the backend saw
+            datums.append(SkeletonDatum(keypoints, frame))
+        return datums
+
+    def _reset_preparers(self, shapes=None):
+        '''
+        Starts following the dancers from the whole frame, and picks the decode size of
+        videos of the given (width, height) shapes, their full size if None
+        '''
+        self._frame_scales = [1.0, 1.0]
+        self._decode_sizes = [None, None]
+        if self.preparers is None:
+            return
+        for stream, preparer in enumerate(self.preparers):
+            preparer.reset()
+            if shapes is None:
+                continue
+            size = preparer.decode_size(*shapes[stream])
+            if size is not None:
+                self._decode_sizes[stream] = size
+                self._frame_scales[stream] = size[0]/shapes[stream][0]
 
-        self.dance_scorer = DanceScorer()
+    def _decode(self, cap, stream):
+        '''
+        decodes a video at the decode size of its stream
+        '''
+        size = self._decode_sizes[stream]
+        if size is None:
+            return iter_frames(cap)
+        return (downscale(frame, size) for frame in iter_frames(cap))
 
-    def process_image(self, image):
-        datum = op.Datum()
-        datum.cvInputData = image
-        self.opWrapper.emplaceAndPop([datum])
-        return datum
+    def process_image(self, image, follow=False):
+        '''
+        :param follow: keep the crop of the previous image, for consecutive frames of one video
+        '''
+        if not follow:
+            self._reset_preparers()
+        return self._estimate([image], [0])[0]
 
 
     def process_image_path(self, path):
+        self._reset_preparers()
         imageToProcess = cv2.imread(path)
         return self.process_image(imageToProcess)
 
@@ -54,74 +222,234 @@ class PoseEstimator:
         :param image2: path to image
         :return:
         '''
-        # Process and display images
-        datum1 = op.Datum()
-        datum1.cvInputData = image1
-        self.opWrapper.emplaceAndPop([datum1])
-        datum2 = op.Datum()
-        datum2.cvInputData = image2
-        self.opWrapper.emplaceAndPop([datum2])
-        assert datum1.poseKeypoints.shape == (1, 25, 3)
-        assert datum2.poseKeypoints.shape == (1, 25, 3)
-        self.dance_scorer.add_frame_pose(datum1.poseKeypoints, datum2.poseKeypoints)
-        return datum1, datum2
+        datums1, datums2 = self.process_batch_pair([image1], [image2])
+        return datums1[0], datums2[0]
+
+    def process_batch_pair(self, images1, images2):
+        '''
+        Generates pose estimation results for a batch of frame pairs in one backend call
+        and evaluates them using DanceScorer
+        :param images1: list of frames from the first video
+        :param images2: list of frames from the second video, extra frames of the longer list are dropped
+        :return: list of datums for images1, list of datums for images2
+        '''
+        count = min(len(images1), len(images2))
+        datums = [[None]*count, [None]*count]
+
+        # Frames with cached keypoints skip the backend, the rest of both videos go in one call
+        pending_frames = []
+        pending = []
+        positions = []
+        for stream, images in enumerate((images1, images2)):
+            cached = self._cached[stream]
+            start = self._positions[stream]
+            selector = self._selectors[stream]
+            for k in range(count):
+                if cached is not None and start + k < len(cached):
+                    datums[stream][k] = SkeletonDatum(np.array(cached[start + k]), images[k])
+                elif selector is None or selector.select(images[k]):
+                    pending_frames.append(images[k])
+                    pending.append((stream, k))
+                    positions.append(len(self._keyframes[stream]) + k)
+            self._positions[stream] += count
+        if pending_frames:
+            streams = [stream for stream, _ in pending]
+            results = self._estimate(pending_frames, streams, positions if self._selectors[0] is not None else None)
+            for (stream, k), datum in zip(pending, results):
+                datums[stream][k] = datum
+        if self._selectors[0] is not None:
+            self._hold_keyframes(datums, (images1, images2), count)
+
+        datums1, datums2 = datums
+        for datum1, datum2 in zip(datums1, datums2):
+            if self.people == 1:
+                assert datum1.poseKeypoints.shape == (1, 25, 3)
+                assert datum2.poseKeypoints.shape == (1, 25, 3)
+            self.dance_scorer.add_frame_pose(datum1.poseKeypoints, datum2.poseKeypoints)
+        return datums1, datums2
 
     def dance_end(self):
-        return self.dance_scorer.score_dancer()
+        scores = self.dance_scorer.score_dancer()
+        if self.warp_scores and self.people == 1:
+            # Timing drift is forgiven in the warped scores, the unwarped ones stay at the top level
+            scores["warped"], scores["warp_offset"], _ = score_dancer_warped(self.dance_scorer, self.warp_band)
+        return scores
         # FEEDBACK AND DISPLAY
         # return 0
 
+    def video_keypoints(self, path):
+        '''
+        Estimates the poses of every frame of a single video, using the keypoint cache if there is one
+        :param path: path to the video
+        :return: (N, people, 25, 3) keypoint array
+        '''
+        key = None
+        if self.keypoint_cache is not None:
+            key = self.keypoint_cache.key(path, self.backend.name, self.cache_params)
+            cached = self.keypoint_cache.get(key)
+            if cached is not None:
+                return cached
+        self.backend.reset()
+        self._reset_preparers()
+        cap = cv2.VideoCapture(path)
+        keypoints = []
+        try:
+            for frames in batched(iter_frames(cap), self.batch_size):
+                keypoints.extend(datum.poseKeypoints for datum in self._estimate(frames, [0]*len(frames)))
+        finally:
+            cap.release()
+        keypoints = np.array(keypoints, dtype=np.float32)
+        if key is not None:
+            self.keypoint_cache.put(key, keypoints)
+        return keypoints
+
     def iterate_over_video(self, path):
+        self._reset_preparers()
         video = cv2.VideoCapture(path)
         fps = video.get(cv2.CAP_PROP_FPS)
         frame_width = video.get(3)
         frame_height = video.get(4)
-        frames = []
+        output = open_writer('result.mp4', fps, (int(frame_width), int(frame_height)))
         with tqdm(total=video.get(cv2.CAP_PROP_FRAME_COUNT), desc='Processing') as pbar:
             while(1):
                 success, frame = video.read()
                 if success:
-                    frames.append(self.process_image(frame).cvOutputData)
+                    output.write(self.process_image(frame, follow=True).cvOutputData)
                     pbar.update(1)
                 else:
                     break
-        print('1/1')
-        self.write_video('result.mp4', frames, fps, (int(frame_width), int(frame_height)))
+        video.release()
+        output.release()
 
     def compare_videos(self, path1, path2, write_skeleton=False, skeleton_out1='', skeleton_out2='',
                        write_aligned=False, aligned_out1='', aligned_out2='',
-                       write_combined=False, combined_out=''):
-        frames1, frames2, fps, shape1, shape2 = align(path1, path2, outpath1=aligned_out1,
-                                                      outpath2=aligned_out2,
-                                                      write=write_aligned)
-
-        cvOut1 = []
-        cvOut2 = []
-        for i in tqdm(range(len(frames1))):
-            datum1, datum2 = self.process_image_pair(frames1[i], frames2[i])
-            cvOut1.append(datum1.cvOutputData)
-            cvOut2.append(datum2.cvOutputData)
+                       write_combined=False, combined_out='', reference=None):
+        '''
+        Decodes, pose-estimates, scores and encodes both videos one frame pair at a time,
+        so memory use stays flat regardless of the length of the videos. When threaded,
+        every stage runs on its own thread connected by bounded queues.
+        :param path1: path to the student video
+        :param path2: path to the teacher video
+        :param reference: TeacherReference of the teacher video, its keypoints, metrics and audio
+                          fingerprint are used instead of recomputing them
+        :return: scores from DanceScorer.score_dancer
+        '''
+        # Every comparison is scored on its own, so poses never leak between requests
+        self.dance_scorer = self.new_scorer()
+        self.backend.reset()
+
+        cap1, cap2, fps, shape1, shape2 = open_aligned(path1, path2, auto_align=self.auto_align, reference=reference)
+        total = cap1.get(cv2.CAP_PROP_FRAME_COUNT)
+
+        starts = [int(cap1.get(cv2.CAP_PROP_POS_FRAMES)), int(cap2.get(cv2.CAP_PROP_POS_FRAMES))]
+        keys = [None, None]
+        if self.keypoint_cache is not None:
+            keys = [self.keypoint_cache.key(path, self.backend.name, self.cache_params) for path in (path1, path2)]
+            self._cached = [self.keypoint_cache.get(key) for key in keys]
+        if reference is not None:
+            profiling.count("teacher_reference.uses")
+            # Teacher frames covered by the reference skip the backend like cached ones
+            self._cached[1] = reference.keypoints
+            self.dance_scorer.use_reference(reference, starts[1])
+        cached_lengths = [0 if cached is None else len(cached) for cached in self._cached]
+        if self.subsampling:
+            self._selectors = [KeyframeSelector(self.keyframe_interval, self.motion_threshold) for _ in range(2)]
+        self._keyframes = [[], []]
+        self._held = [None, None]
+        # Frames are decoded small when only keypoints are needed, the written outputs need them at full size
+        full_size = write_aligned or write_skeleton or write_combined
+        self._reset_preparers(None if full_size else (shape1, shape2))
+        self.last_comparison = {"paths" : (path1, path2), "starts" : starts, "fps" : fps, "shapes" : (shape1, shape2)}
+        self._positions = list(starts)
+
+        # Each output is a writer and a function picking its frame from (frame1, frame2, datum1, datum2)
+        outputs = []
+        if write_aligned:
+            outputs.append((open_writer(aligned_out1, fps, shape1), lambda f1, f2, d1, d2: f1))
+            outputs.append((open_writer(aligned_out2, fps, shape2), lambda f1, f2, d1, d2: f2))
         if write_skeleton:
-            print('1/2')
-            self.write_video(skeleton_out1, cvOut1, fps, shape1)
-            print('2/2')
-            self.write_video(skeleton_out2, cvOut2, fps, shape2)
+            outputs.append((open_writer(skeleton_out1, fps, shape1), lambda f1, f2, d1, d2: d1.cvOutputData))
+            outputs.append((open_writer(skeleton_out2, fps, shape2), lambda f1, f2, d1, d2: d2.cvOutputData))
         if write_combined:
-            check_alignment(frames1, frames2, fps, shape1, shape2, combined_out)
+            shape = combined_shape(shape1, shape2)
+            outputs.append((open_writer(combined_out, fps, shape), lambda f1, f2, d1, d2: combine_frames(f1, f2, shape)))
+
+        pbar = tqdm(total=total)
+
+        def encode(batches, datums):
+            for frames in zip(*batches, *datums):
+                for output, select in outputs:
+                    output.write(select(*frames))
+                pbar.update(1)
+
+        try:
+            sources = [batched(self._decode(cap1, 0), self.batch_size), batched(self._decode(cap2, 1), self.batch_size)]
+            if self.threaded:
+                self.stage_timings = StagedPipeline(self.queue_depth, size=len, nbytes=_batch_bytes).run(sources, self.process_batch_pair, encode)
+            else:
+                self.stage_timings = run_sequential(sources, self.process_batch_pair, encode, size=len, nbytes=_batch_bytes)
+        finally:
+            pbar.close()
+            cap1.release()
+            cap2.release()
+            for output, _ in outputs:
+                output.release()
+            self._cached = [None, None]
+            self._selectors = [None, None]
+            self._reset_preparers()
+
+        profile = profiling.active()
+        if profile is not None:
+            profile.add_timings(self.stage_timings, "compare.")
+            profile.count("frames", len(self.dance_scorer.poses["student"]))
+        if self.subsampling:
+            with profiling.stage("compare.interpolate", len(self.dance_scorer.poses["student"])):
+                self.interpolate_skipped()
+            keyframes = [int(sum(keyframes)) for keyframes in self._keyframes]
+            self.last_comparison["keyframes"] = keyframes
+            profiling.count("keyframes", sum(keyframes))
+        # Store keypoints that cover more of a video than its cache entry, which needs a run from the first frame,
+        # interpolated keypoints are not stored as they would be served as estimated ones
+        if self.keypoint_cache is not None and not self.subsampling:
+            for key, start, cached_length, dancer in zip(keys, starts, cached_lengths, ("student", "teacher")):
+                poses = self.dance_scorer.poses[dancer]
+                if start == 0 and len(poses) > cached_length:
+                    self.keypoint_cache.put(key, poses.view())
         return self.dance_end()
 
     def write_video(self, fname, frames,fps, shape):
-        api = cv2.CAP_FFMPEG
-        code = cv2.VideoWriter.fourcc('m', 'p', '4', 'v')
-        output = cv2.VideoWriter(fname, api, code, fps, shape)
-        with tqdm(total=len(frames), desc='Writing') as pbar:
+        output = open_writer(fname, fps, shape)
+        with profiling.stage("encode.write_video", len(frames)), tqdm(total=len(frames), desc='Writing') as pbar:
             for frame in frames:
                 output.write(frame)
                 pbar.update(1)
         output.release()
 
-    def get_wireframe(self, outpath):
-        self.dance_scorer.generate_wireframe_video(outpath)
+    def get_wireframe(self, outpath, scale=1.0):
+        self.dance_scorer.generate_wireframe_video(outpath, scale)
+
+    def encode_outputs(self, skeleton_out1='', skeleton_out2='', wireframe_out='', wireframe_scale=1.0):
+        '''
+        Renders the skeleton overlays and the wireframe of the last compare_videos call
+        concurrently on the encoder's process pool. The overlays are drawn from the scored
+        keypoints onto the aligned source frames.
+        :param skeleton_out1: path of the student overlay, skipped if empty
+        :param skeleton_out2: path of the teacher overlay, skipped if empty
+        :param wireframe_out: path of the wireframe video, skipped if empty
+        :return: dictionary mapping every output path to the number of frames written
+        '''
+        assert self.encoder is not None, "encode_outputs needs a PoseEstimator created with an encoder"
+        assert self.last_comparison is not None, "encode_outputs renders the outputs of compare_videos"
+        comparison = self.last_comparison
+        jobs = []
+        for out, dancer, path, start, shape in zip((skeleton_out1, skeleton_out2), ("student", "teacher"),
+                                                   comparison["paths"], comparison["starts"], comparison["shapes"]):
+            if out:
+                jobs.append(self.encoder.overlay_job(out, self.dance_scorer.poses[dancer], path, start,
+                                                     comparison["fps"], shape))
+        if wireframe_out:
+            jobs.append(self.encoder.wireframe_job(wireframe_out, self.dance_scorer, wireframe_scale))
+        return self.encoder.encode(jobs)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,149 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Profile collecting the measurements of the current thread, None when profiling is off
+_local = threading.local()
+
+
+class StageTimings:
+    """Accumulates busy time and item counts per pipeline stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, seconds, items=1):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"seconds" : 0.0, "items" : 0})
+            entry["seconds"] += seconds
+            entry["items"] += items
+
+    def as_dict(self):
+        """
+        Returns:
+            A dictionary mapping every stage to its busy seconds, item count and items per second
+        """
+        with self._lock:
+            return {
+                stage : dict(entry, fps = entry["items"]/entry["seconds"] if entry["seconds"] > 0 else 0.0)
+                for stage, entry in self.stages.items()
+            }
+
+
+class Profile:
+    """Stage timings, counters and peak values collected while handling one request.
+
+    A profile is made active for a thread with `profiling`, after which the hooks in
+    this module (stage, timed, count, peak) record into it. Without an active profile
+    the hooks only look up one thread-local attribute and return.
+    """
+
+    def __init__(self):
+        self.timings = StageTimings()
+        self.counters = {}
+        self.peaks = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def peak(self, name, value):
+        with self._lock:
+            if value > self.peaks.get(name, value - 1):
+                self.peaks[name] = value
+
+    def add_timings(self, timings, prefix=""):
+        '''
+        adds the stages of a StageTimings.as_dict result, e.g. PoseEstimator.stage_timings
+        '''
+        for stage, entry in timings.items():
+            self.timings.add(prefix + stage, entry["seconds"], entry["items"])
+
+    def merge(self, other):
+        '''
+        adds the timings and counters of another profile and keeps the larger peaks
+        '''
+        self.add_timings(other.timings.as_dict())
+        for name, amount in other.counters.items():
+            self.count(name, amount)
+        for name, value in other.peaks.items():
+            self.peak(name, value)
+
+    def as_dict(self):
+        with self._lock:
+            counters = dict(self.counters)
+            peaks = dict(self.peaks)
+        return {"stages" : self.timings.as_dict(), "counters" : counters, "peaks" : peaks}
+
+
+# Sum of the profiles of every finished request, served by the metrics endpoint
+totals = Profile()
+
+
+def active():
+    return getattr(_local, "profile", None)
+
+
+@contextmanager
+def profiling(profile):
+    """Makes profile the active profile of the calling thread for the duration of a with block.
+
+    Passing None disables profiling inside the block. Worker threads do not inherit the
+    active profile, code starting threads hands it over explicitly.
+    """
+    previous = getattr(_local, "profile", None)
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+
+@contextmanager
+def stage(name, items=1):
+    '''
+    times the body of a with block as one run of a stage processing `items` items
+    '''
+    profile = getattr(_local, "profile", None)
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.timings.add(name, time.perf_counter() - start, items)
+
+
+def timed(name):
+    '''
+    decorator timing every call of a function as one item of a stage
+    '''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profile = getattr(_local, "profile", None)
+            if profile is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.timings.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def count(name, amount=1):
+    profile = getattr(_local, "profile", None)
+    if profile is not None:
+        profile.count(name, amount)
+
+
+def peak(name, value):
+    profile = getattr(_local, "profile", None)
+    if profile is not None:
+        profile.peak(name, value)
@@ -0,0 +1,81 @@
+import numpy as np
+
+from DanceScorer import DanceScorer, ANGLE_JOINTS, calc_joint_angles, stack_poses
+from pose_buffer import PoseBuffer
+
+
+class StreamingDanceScorer(DanceScorer):
+    """DanceScorer that keeps scores up to date while frames are being added.
+
+    Every call to add_frame_pose computes the joint angles of the new frame pair and
+    extends a running (prefix) sum of the per-joint position errors. The overall
+    score and the score over any trailing window are then available at any time in
+    O(1), without recomputing the metrics of the whole routine.
+    """
+
+    def __init__(self, fps=30, window_seconds=2):
+        """
+        Args:
+            fps: Frame rate of the incoming poses, used to convert windows to frames
+            window_seconds: Default length of the window used by window_scores
+        """
+        super().__init__()
+        self.fps = fps
+        self.window_seconds = window_seconds
+
+        # Row i holds the summed position error of every joint over the first i frames
+        self._error_sums = PoseBuffer(frame_shape = (len(ANGLE_JOINTS),), dtype = np.float64)
+        self._error_sums.append(np.zeros(len(ANGLE_JOINTS)))
+
+    def add_frame_pose(self, student_pose, teacher_pose):
+        """Add pose from a pair of frames from the student and teacher and update the running errors.
+
+        Args:
+            student_pose: A (1, 25, 3) array with the keypoints of the student
+            teacher_pose: A (1, 25, 3) array with the keypoints of the teacher
+        """
+        super().add_frame_pose(student_pose, teacher_pose)
+
+        student_angles = calc_joint_angles(stack_poses([student_pose]))[0]
+        teacher_angles = calc_joint_angles(stack_poses([teacher_pose]))[0]
+
+        # Joints missing from either dancer count as zero error, the same as in score_dancer. Keypoints
+        # on top of each other give NaN angles, which would spoil every later sum, so they count as missing
+        error = np.abs(student_angles - teacher_angles)
+        valid = (student_angles != -1) & (teacher_angles != -1) & np.isfinite(error)
+        error = np.where(valid, error, 0)
+        self._error_sums.append(self._error_sums[-1] + error)
+
+    def num_frames(self):
+        return len(self._error_sums) - 1
+
+    def _window_errors(self, num_frames):
+        sums = self._error_sums.view()
+        errors = (sums[-1] - sums[-1 - num_frames])/num_frames
+        return dict(zip(ANGLE_JOINTS, errors))
+
+    def current_scores(self):
+        """Scores the routine so far.
+
+        Returns:
+            The same dictionary as score_dancer, or None if no frames have been added
+        """
+        if self.num_frames() == 0:
+            return None
+        return self._scores_from_errors(self._window_errors(self.num_frames()))
+
+    def window_scores(self, seconds=None):
+        """Scores only the most recent part of the routine.
+
+        Args:
+            seconds: Length of the trailing window, defaults to window_seconds
+
+        Returns:
+            The same dictionary as score_dancer, or None if no frames have been added
+        """
+        if seconds is None:
+            seconds = self.window_seconds
+        num_frames = min(self.num_frames(), max(int(round(seconds*self.fps)), 1))
+        if num_frames == 0:
+            return None
+        return self._scores_from_errors(self._window_errors(num_frames))
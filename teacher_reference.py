@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from alignment import AUDIO_WINDOW
+from alignment_by_row_channels import fingerprint, load_audio
+from DanceScorer import ANGLE_JOINTS, DanceScorer, calc_joint_angles, calc_joint_velocities, stack_poses
+from file_hashing import cached_file_hash
+
+# Bumped whenever the stored arrays change meaning, older references are rejected on load
+REFERENCE_VERSION = 1
+
+# Arrays stored next to metadata.json, every one as its own .npy file so it can be memory mapped
+_ARRAYS = ["keypoints", "angles", "velocities", "valid", "window_means", "window_valid", "sigmas"]
+
+
+class TeacherReference:
+    """Precomputed teacher side of a comparison.
+
+    Holds the teacher keypoints, the joint angles and velocities stored joint-major
+    (one contiguous row per joint, as DanceScorer keeps its metrics), the validity mask,
+    per-window means of the angles, the scoring sigmas and the audio fingerprint of the
+    start of the teacher video. A reference is a directory of .npy files and a
+    metadata.json, loaded memory-mapped so many workers can share one copy.
+    """
+
+    def __init__(self, arrays, metadata, audio=None):
+        """
+        Args:
+            arrays: Dictionary holding every array named in _ARRAYS
+            metadata: Dictionary stored as metadata.json
+            audio: (freqs, times) fingerprint of the first metadata["audio"]["seconds"] of audio, or None
+        """
+        self.metadata = metadata
+        for name in _ARRAYS:
+            setattr(self, name, arrays[name])
+        self.audio = audio
+
+    @property
+    def frames(self):
+        return self.metadata["frames"]
+
+    @property
+    def audio_rate(self):
+        return self.metadata["audio"]["rate"] if self.audio is not None else None
+
+    def audio_peaks(self, seconds):
+        '''
+        :return: stored audio fingerprint if it covers exactly `seconds` of audio, otherwise None
+        '''
+        if self.audio is None or self.metadata["audio"]["seconds"] != seconds:
+            return None
+        return self.audio
+
+    @classmethod
+    def build(cls, poses, video=None, fps=30, window_seconds=2, audio_seconds=AUDIO_WINDOW):
+        """Computes a reference from teacher poses.
+
+        Args:
+            poses: Teacher poses, anything accepted by stack_poses
+            video: Path to the teacher video, its audio is fingerprinted if given
+            fps: Frame rate of the poses, used to size the summary windows
+            window_seconds: Length of the windows summarized in window_means
+            audio_seconds: Seconds of audio fingerprinted, as read by alignment.audio_offset
+
+        Returns:
+            A TeacherReference
+        """
+        keypoints = stack_poses(poses)
+        angles = calc_joint_angles(keypoints)
+        valid = angles != -1
+
+        # Mean angle of every joint over consecutive windows, ignoring missing joints
+        window = max(1, int(round(window_seconds*fps)))
+        windows = -(-len(angles) // window)
+        padded_valid = np.zeros(shape = (windows*window, len(ANGLE_JOINTS)), dtype = bool)
+        padded_valid[:len(angles)] = valid
+        padded_angles = np.zeros(shape = padded_valid.shape, dtype = np.float64)
+        padded_angles[:len(angles)] = np.where(valid, angles, 0)
+        counts = padded_valid.reshape(windows, window, -1).sum(axis = 1)
+        sums = padded_angles.reshape(windows, window, -1).sum(axis = 1)
+        lengths = np.minimum(window, len(angles) - np.arange(windows)*window)[:, None]
+        window_means = np.where(counts > 0, sums/np.maximum(counts, 1), -1).astype(np.float32)
+        window_valid = (counts/lengths).astype(np.float32)
+
+        arrays = {
+            "keypoints" : keypoints[:, None],
+            "angles" : np.ascontiguousarray(angles.T),
+            "velocities" : np.ascontiguousarray(calc_joint_velocities(keypoints).T),
+            "valid" : np.ascontiguousarray(valid.T),
+            "window_means" : window_means,
+            "window_valid" : window_valid,
+            "sigmas" : np.array([DanceScorer.RANGE[joint]/DanceScorer.SIGMA_SCALE for joint in ANGLE_JOINTS],
+                                dtype = np.float32)
+        }
+        metadata = {
+            "version" : REFERENCE_VERSION,
+            "joints" : list(ANGLE_JOINTS),
+            "frames" : len(keypoints),
+            "fps" : fps,
+            "window_frames" : window,
+            "source" : os.path.basename(video) if video else None,
+            "source_hash" : cached_file_hash(video) if video else None,
+            "audio" : None
+        }
+
+        audio = None
+        if video is not None:
+            samples, rate = load_audio(video, seconds = audio_seconds)
+            audio = fingerprint(samples)
+            metadata["audio"] = {"rate" : rate, "seconds" : audio_seconds}
+        return cls(arrays, metadata, audio)
+
+    def save(self, directory):
+        """Writes the reference to a directory, replacing any reference already there."""
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok = True)
+        # Written next to the target first so readers never see a partial reference
+        tmp_directory = os.path.join(parent, ".{}.{}.tmp".format(os.path.basename(directory), uuid.uuid4().hex))
+        os.makedirs(tmp_directory)
+        for name in _ARRAYS:
+            np.save(os.path.join(tmp_directory, name + ".npy"), getattr(self, name))
+        if self.audio is not None:
+            np.save(os.path.join(tmp_directory, "audio_peaks.npy"), np.stack(self.audio))
+        with open(os.path.join(tmp_directory, "metadata.json"), "w") as f:
+            json.dump(self.metadata, f, indent = 2)
+        shutil.rmtree(directory, ignore_errors = True)
+        os.replace(tmp_directory, directory)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Opens a saved reference.
+
+        Raises:
+            ValueError if the reference was written by an incompatible version
+        """
+        with open(os.path.join(directory, "metadata.json")) as f:
+            metadata = json.load(f)
+        if metadata.get("version") != REFERENCE_VERSION or metadata.get("joints") != list(ANGLE_JOINTS):
+            raise ValueError("Reference {} has version {}, expected {}".format(
+                directory, metadata.get("version"), REFERENCE_VERSION))
+        arrays = {name : np.load(os.path.join(directory, name + ".npy"), mmap_mode = mmap_mode) for name in _ARRAYS}
+        audio = None
+        if metadata["audio"] is not None:
+            freqs, times = np.load(os.path.join(directory, "audio_peaks.npy"))
+            audio = (freqs, times)
+        return cls(arrays, metadata, audio)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Builds a teacher reference from a video or a .npy keypoint file")
+    parser.add_argument("source", help = "teacher video or .npy keypoints")
+    parser.add_argument("output", help = "directory the reference is written to")
+    parser.add_argument("--video", help = "teacher video to fingerprint when source is a .npy file")
+    parser.add_argument("--backend", help = "pose backend used when source is a video")
+    parser.add_argument("--fps", type = float, default = 30)
+    args = parser.parse_args()
+
+    if args.source.endswith(".npy"):
+        poses = np.load(args.source)
+        video = args.video
+    else:
+        from pose_estimation import PoseEstimator
+        poses = PoseEstimator(backend = args.backend).video_keypoints(args.source)
+        video = args.source
+    TeacherReference.build(poses, video, args.fps).save(args.output)
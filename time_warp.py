@@ -0,0 +1,177 @@
+import numpy as np
+
+import profiling
+from DanceScorer import ANGLE_JOINTS, calc_joint_angles, stack_poses
+
+
+def masked_angles(poses):
+    """Joint angles of every frame with missing joints set to NaN.
+
+    Args:
+        poses: Anything accepted by stack_poses
+
+    Returns:
+        A float32 array of shape (N, 10)
+    """
+    angles = calc_joint_angles(stack_poses(poses))
+    angles[angles == -1] = np.nan
+    return angles
+
+
+def xcorr_offset(student, teacher, max_offset=None):
+    """Finds the global shift between two joint angle series with an FFT cross-correlation.
+
+    Args:
+        student: (N, 10) angles with NaN for missing joints
+        teacher: (M, 10) angles with NaN for missing joints
+        max_offset: Largest shift in frames to consider, unbounded if None
+
+    Returns:
+        The offset d in frames such that student frame i best matches teacher frame i + d
+    """
+    n, m = len(student), len(teacher)
+    if n == 0 or m == 0:
+        return 0
+    valid_s = ~np.isnan(student)
+    valid_t = ~np.isnan(teacher)
+    # Centre every joint so the correlation follows the movement rather than the mean pose
+    s = np.where(valid_s, student - np.nanmean(student, axis = 0), 0).astype(np.float64)
+    t = np.where(valid_t, teacher - np.nanmean(teacher, axis = 0), 0).astype(np.float64)
+
+    length = 1 << int(np.ceil(np.log2(n + m)))
+    def correlate(a, b):
+        spectrum = np.conj(np.fft.rfft(a, length, axis = 0))*np.fft.rfft(b, length, axis = 0)
+        return np.fft.irfft(spectrum.sum(axis = 1), length)
+
+    # Normalise by the number of overlapping valid samples so short overlaps are not favoured
+    correlation = correlate(s, t)
+    overlap = np.rint(correlate(valid_s.astype(np.float64), valid_t.astype(np.float64)))
+
+    offsets = np.arange(-(n - 1), m)
+    if max_offset is not None:
+        offsets = offsets[np.abs(offsets) <= max_offset]
+    counts = overlap[offsets % length]
+    # Require at least half of the shorter series to overlap
+    min_count = 0.5*min(n, m)*len(ANGLE_JOINTS)
+    scores = np.where(counts >= min_count, correlation[offsets % length]/np.maximum(counts, 1), -np.inf)
+    if not np.isfinite(scores).any():
+        return 0
+    return int(offsets[np.argmax(scores)])
+
+
+def _band_costs(student, teacher, offset, band):
+    """Per-frame costs inside a Sakoe-Chiba band around the diagonal j = i + offset.
+
+    Returns:
+        rows, an (R, 2*band+1) float64 cost array with inf outside the teacher, and
+        the teacher column of the first band entry of every row
+    """
+    n, m = len(student), len(teacher)
+    rows = np.arange(max(0, -offset - band), min(n, m - offset + band))
+    width = 2*band + 1
+    lo = rows + offset - band
+    columns = lo[:, None] + np.arange(width)[None, :]
+    inside = (columns >= 0) & (columns < m)
+    clipped = np.clip(columns, 0, m - 1)
+
+    total = np.zeros(shape = columns.shape, dtype = np.float32)
+    for joint in range(student.shape[1]):
+        s = student[rows, joint][:, None]
+        t = teacher[clipped, joint]
+        # Joints missing from either dancer count as zero error, as in score_dancer
+        total += np.nan_to_num(np.abs(s - t), nan = 0.0)
+    costs = (total/student.shape[1]).astype(np.float64)
+    costs[~inside] = np.inf
+    return rows, costs, lo
+
+
+def banded_dtw(student, teacher, offset=0, band=60):
+    """Dynamic time warping restricted to a band of +-band frames around j = i + offset.
+
+    Every row of the accumulated cost is computed with a handful of array operations:
+    the within-row recursion D[j] = min(A[j], D[j-1] + c[j]) is a min-plus prefix scan,
+    D = C + minimum.accumulate(A - C) with C the cumulative row cost. The total work is
+    O(N*band) with only one python iteration per row. The path may start and end
+    anywhere inside the first and last row of the band.
+
+    Args:
+        student: (N, 10) angles with NaN for missing joints
+        teacher: (M, 10) angles with NaN for missing joints
+        offset: Centre of the band, e.g. from xcorr_offset
+        band: Half width of the band in frames
+
+    Returns:
+        The warping path as two equal length arrays of student and teacher frame indices
+    """
+    rows, costs, lo = _band_costs(student, teacher, offset, band)
+    if len(rows) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    width = costs.shape[1]
+
+    accumulated = np.full(shape = costs.shape, fill_value = np.inf)
+    accumulated[0] = costs[0]
+    for r in range(1, len(rows)):
+        c = costs[r]
+        prev = accumulated[r - 1]
+        # Column lo[r] + k sits at index k + 1 of the previous row
+        up = np.append(prev[1:], np.inf)
+        step = c + np.minimum(prev, up)
+        valid = np.flatnonzero(np.isfinite(c))
+        if len(valid) == 0:
+            continue
+        a, b = valid[0], valid[-1] + 1
+        cumulative = np.cumsum(c[a:b])
+        accumulated[r, a:b] = cumulative + np.minimum.accumulate(step[a:b] - cumulative)
+
+    # Open end: finish at the cheapest cell of the last row with a finite cost
+    last = len(rows) - 1
+    while last > 0 and not np.isfinite(accumulated[last]).any():
+        last -= 1
+    k = int(np.argmin(accumulated[last]))
+    r = last
+    path_rows = [r]
+    path_ks = [k]
+    while r > 0:
+        # Candidates are the diagonal (r-1, k), up (r-1, k+1) and left (r, k-1)
+        diagonal = accumulated[r - 1, k]
+        up = accumulated[r - 1, k + 1] if k + 1 < width else np.inf
+        left = accumulated[r, k - 1] if k > 0 else np.inf
+        best = min(diagonal, up, left)
+        if not np.isfinite(best):
+            break
+        if best == left:
+            k -= 1
+        elif best == diagonal:
+            r -= 1
+        else:
+            r -= 1
+            k += 1
+        path_rows.append(r)
+        path_ks.append(k)
+
+    path_rows = np.array(path_rows[::-1])
+    path_ks = np.array(path_ks[::-1])
+    return rows[path_rows], lo[path_rows] + path_ks
+
+
+@profiling.timed("score.time_warp")
+def score_dancer_warped(dance_scorer, band=60, max_offset=None):
+    """Scores the student after warping it onto the teacher's timing.
+
+    Args:
+        dance_scorer: DanceScorer holding the student and teacher poses
+        band: Half width of the DTW band in frames
+        max_offset: Largest global shift in frames searched by the cross-correlation
+
+    Returns:
+        The scores of the warped comparison (same layout as score_dancer), the global
+        offset in frames and the length of the warping path
+    """
+    student = masked_angles(dance_scorer.poses["student"])
+    teacher = masked_angles(dance_scorer.poses["teacher"])
+    offset = xcorr_offset(student, teacher, max_offset)
+    student_frames, teacher_frames = banded_dtw(student, teacher, offset, band)
+
+    errors = np.nan_to_num(np.abs(student[student_frames] - teacher[teacher_frames]), nan = 0.0)
+    avg_position_errors = errors.mean(axis = 0) if len(errors) else np.zeros(len(ANGLE_JOINTS))
+    return dance_scorer._scores_from_errors(avg_position_errors), offset, len(student_frames)
@@ -0,0 +1,266 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+
+import profiling
+from alignment import open_writer
+from DanceScorer import draw_skeleton, stack_people
+
+# One output video: render(start, *data_chunk, **options) yields the frames of [start, start + len(chunk)),
+# every array in data is cut along its first axis, options are passed to every chunk unchanged
+EncodeJob = namedtuple("EncodeJob", ["fname", "render", "data", "options", "fps", "shape"])
+
+
+def render_frames(start, frames):
+    '''
+    renders frames that already exist, e.g. the lists written by write_video
+    '''
+    return frames
+
+
+def render_wireframe(start, student, teacher, scale=1.0):
+    '''
+    renders a chunk of the wireframe video of generate_wireframe_video
+    '''
+    # Imported here as the renderer itself builds on DanceScorer
+    from wireframe import WireframeRenderer
+
+    return WireframeRenderer(scale = scale).render(student, teacher)
+
+
+def render_overlay(start, poses, video, first_frame=0):
+    '''
+    renders a chunk of a skeleton overlay by decoding the source video and drawing the keypoints on it
+    :param start: index of the first pose of the chunk
+    :param poses: (N, P, 25, 3) keypoints of the chunk, every person is drawn
+    :param video: path to the source video
+    :param first_frame: frame of the source video matching pose 0, i.e. its alignment offset
+    '''
+    cap = cv2.VideoCapture(video)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, first_frame + start)
+    try:
+        for pose in poses:
+            success, frame = cap.read()
+            if not success:
+                break
+            for person in pose:
+                draw_skeleton(frame, person[None], (0, 255, 0), thickness = 4)
+            yield frame
+    finally:
+        cap.release()
+
+
+def _encode_chunk(fname, render, data, options, start, fps, shape):
+    '''
+    renders and encodes one chunk to its own file in a worker process
+    :return: number of frames written, seconds spent
+    '''
+    began = time.perf_counter()
+    output = open_writer(fname, fps, shape)
+    count = 0
+    try:
+        for frame in render(start, *data, **options):
+            output.write(frame)
+            count += 1
+    finally:
+        output.release()
+    return count, time.perf_counter() - began
+
+
+def _concat_av(av, segments, fname):
+    # Stream copy of the packets, shifting every segment to start where the previous one ended
+    with av.open(fname, "w") as output:
+        stream = None
+        offset = 0
+        for segment in segments:
+            with av.open(segment) as source:
+                video = source.streams.video[0]
+                if stream is None:
+                    stream = output.add_stream_from_template(video)
+                end = offset
+                for packet in source.demux(video):
+                    # The demuxer ends with an empty flush packet
+                    if packet.dts is None:
+                        continue
+                    packet.pts += offset
+                    packet.dts += offset
+                    end = max(end, packet.pts + packet.duration)
+                    packet.stream = stream
+                    output.mux(packet)
+                offset = end
+
+
+def _concat_ffmpeg(binary, segments, fname):
+    with tempfile.NamedTemporaryFile("w", suffix = ".txt", delete = False) as listing:
+        for segment in segments:
+            listing.write("file '{}'\n".format(os.path.abspath(segment).replace("'", "'\\''")))
+    try:
+        subprocess.run([binary, "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", listing.name,
+                        "-c", "copy", fname], check = True)
+    finally:
+        os.remove(listing.name)
+
+
+def _concat_reencode(segments, fname, fps, shape):
+    output = open_writer(fname, fps, shape)
+    try:
+        for segment in segments:
+            cap = cv2.VideoCapture(segment)
+            while True:
+                success, frame = cap.read()
+                if not success:
+                    break
+                output.write(frame)
+            cap.release()
+    finally:
+        output.release()
+
+
+def concat_segments(segments, fname, fps, shape):
+    '''
+    Joins encoded segments into one video without re-encoding them
+    Uses PyAV when it is installed, otherwise the ffmpeg concat demuxer. Without either the
+    segments are decoded and encoded again, which loses quality.
+    :param segments: paths of the segments in playback order
+    :param fname: path of the joined video
+    '''
+    try:
+        import av
+    except ImportError:
+        av = None
+    if av is not None:
+        _concat_av(av, segments, fname)
+        return
+    binary = shutil.which("ffmpeg")
+    if binary is not None:
+        _concat_ffmpeg(binary, segments, fname)
+        return
+    _concat_reencode(segments, fname, fps, shape)
+
+
+class VideoEncoder:
+    """Renders and encodes output videos in chunks on a process pool.
+
+    The frame range of every output is cut into chunks of chunk_frames frames, each
+    chunk is rendered and encoded to its own segment by a worker process, and the
+    segments are concatenated losslessly once all of them are done. All chunks of all
+    outputs passed to one encode call are queued together, so independent outputs are
+    produced concurrently and the render time scales with the number of workers.
+    """
+
+    def __init__(self, workers=None, chunk_frames=240):
+        """
+        Args:
+            workers: Number of worker processes, defaults to the number of cores
+            chunk_frames: Frames per segment, each segment starts with a key frame
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_frames = chunk_frames
+        self._lock = threading.Lock()
+        self._executor = self._start_executor()
+
+    def _start_executor(self):
+        # Workers are spawned rather than forked, as the encoder is used from threaded servers
+        return ProcessPoolExecutor(max_workers = self.workers, mp_context = multiprocessing.get_context("spawn"))
+
+    def _restart(self, broken):
+        """Replaces an executor a dead worker broke, unless another thread already did."""
+        with self._lock:
+            if self._executor is broken:
+                broken.shutdown(wait = False, cancel_futures = True)
+                self._executor = self._start_executor()
+
+    def encode(self, jobs):
+        """Renders and encodes several output videos at once.
+
+        Args:
+            jobs: A list of EncodeJob
+
+        Returns:
+            A dictionary mapping every output file to the number of frames written
+
+        Raises:
+            BrokenProcessPool: If a worker died again while the jobs were retried on a fresh pool
+        """
+        with profiling.stage("encode.parallel", sum(min(len(array) for array in job.data) for job in jobs)):
+            executor = self._executor
+            try:
+                return self._encode(jobs, executor)
+            except BrokenProcessPool:
+                # A worker killed by the system or a crashing codec breaks the whole pool for good, so
+                # the pool is replaced for later calls and these jobs are tried once more on it
+                self._restart(executor)
+                return self._encode(jobs, self._executor)
+
+    def _encode(self, jobs, executor):
+        pending = []
+        written = {}
+        try:
+            for job in jobs:
+                frames = min(len(array) for array in job.data)
+                workdir = tempfile.mkdtemp(prefix = ".segments-", dir = os.path.dirname(os.path.abspath(job.fname)))
+                futures = []
+                pending.append((job, workdir, futures))
+                for start in range(0, frames, self.chunk_frames):
+                    stop = min(start + self.chunk_frames, frames)
+                    segment = os.path.join(workdir, "{:06d}.mp4".format(len(futures)))
+                    futures.append((segment, executor.submit(
+                        _encode_chunk, segment, job.render, tuple(array[start:stop] for array in job.data),
+                        job.options, start, job.fps, job.shape)))
+
+            for job, workdir, futures in pending:
+                segments = []
+                count = 0
+                for segment, future in futures:
+                    frames, _ = future.result()
+                    if frames:
+                        segments.append(segment)
+                        count += frames
+                if segments:
+                    concat_segments(segments, job.fname, job.fps, job.shape)
+                else:
+                    open_writer(job.fname, job.fps, job.shape).release()
+                written[job.fname] = count
+        finally:
+            for _, workdir, futures in pending:
+                for _, future in futures:
+                    future.cancel()
+                shutil.rmtree(workdir, ignore_errors = True)
+        return written
+
+    def write_video(self, fname, frames, fps, shape):
+        '''
+        parallel replacement of write_video for frames that are already in memory
+        '''
+        return self.encode([EncodeJob(fname, render_frames, (np.asarray(frames),), {}, fps, shape)])[fname]
+
+    def wireframe_job(self, fname, dance_scorer, scale=1.0):
+        '''
+        :return: EncodeJob rendering the wireframe video of generate_wireframe_video
+        '''
+        from wireframe import WireframeRenderer
+
+        student = stack_people(dance_scorer.poses["student"])
+        teacher = stack_people(dance_scorer.poses["teacher"])
+        return EncodeJob(fname, render_wireframe, (student, teacher), {"scale" : scale}, 30,
+                         WireframeRenderer(scale = scale).frame_size)
+
+    def overlay_job(self, fname, poses, video, first_frame, fps, shape):
+        '''
+        :return: EncodeJob drawing poses onto the frames of video starting at first_frame
+        '''
+        return EncodeJob(fname, render_overlay, (stack_people(poses),),
+                         {"video" : video, "first_frame" : first_frame}, fps, shape)
+
+    def shutdown(self):
+        self._executor.shutdown()
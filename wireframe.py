@@ -0,0 +1,78 @@
+import numpy as np
+
+import cv2
+
+from DanceScorer import JOINT_CONNECTIONS, MIN_CONFIDENCE, stack_people
+
+_STARTS, _ENDS = np.array(JOINT_CONNECTIONS, dtype = np.intp).T
+
+
+class WireframeRenderer:
+    """Renders teacher and student skeletons stacked on a black background.
+
+    The limb segments and their visibility are computed for the whole sequence up
+    front, so drawing a frame is one cv2.polylines call per dancer on a canvas that
+    is allocated once and cleared in place. The teacher is drawn in red on the top
+    half and the student in blue on the bottom half, as generate_wireframe_video did.
+    """
+
+    def __init__(self, resolution=(1920, 1080), scale=1.0, thickness=9):
+        """
+        Args:
+            resolution: (width, height) of the videos the keypoints were estimated on
+            scale: Output size relative to resolution, e.g. 0.5 renders 960x1080 frames
+            thickness: Line thickness in pixels at full resolution
+        """
+        self.scale = scale
+        self.width = int(round(resolution[0]*scale))
+        self.height = int(round(resolution[1]*scale))
+        self.thickness = max(1, int(round(thickness*scale)))
+        self.canvas = np.zeros(shape = (2*self.height, self.width, 3), dtype = np.uint8)
+        # Views into the canvas, drawing on them draws on the canvas
+        self.panels = (self.canvas[:self.height], self.canvas[self.height:])
+
+    @property
+    def frame_size(self):
+        """(width, height) of the rendered frames, as expected by cv2.VideoWriter."""
+        return (self.width, 2*self.height)
+
+    def prepare(self, poses):
+        """Precomputes the limb segments of every frame.
+
+        Args:
+            poses: Anything accepted by stack_people, every person is drawn
+
+        Returns:
+            An (N, P*16, 2, 2) int32 array of segment end points in output pixels and an
+            (N, P*16) bool array telling which segments have both keypoints confident
+        """
+        poses = stack_people(poses)
+        frames = len(poses)
+        confident = poses[..., 2] > MIN_CONFIDENCE
+        visible = (confident[..., _STARTS] & confident[..., _ENDS]).reshape(frames, -1)
+        points = poses[..., :2]
+        if self.scale != 1.0:
+            points = points*self.scale
+        points = points.astype(np.int32)
+        segments = np.stack((points[:, :, _STARTS], points[:, :, _ENDS]), axis = 3).reshape(frames, -1, 2, 2)
+        return segments, visible
+
+    def render(self, student, teacher):
+        """Yields the combined wireframe of every frame both dancers have.
+
+        The same canvas is yielded every time, copy it if it has to outlive the next frame.
+
+        Args:
+            student: Student poses, anything accepted by stack_people
+            teacher: Teacher poses, anything accepted by stack_people
+        """
+        dancers = [(self.panels[0], self.prepare(teacher), (0, 0, 255)),
+                   (self.panels[1], self.prepare(student), (255, 0, 0))]
+        frames = min(len(segments) for _, (segments, _), _ in dancers)
+        for i in range(frames):
+            self.canvas.fill(0)
+            for panel, (segments, visible), color in dancers:
+                lines = segments[i, visible[i]]
+                if len(lines):
+                    cv2.polylines(panel, lines, False, color, self.thickness)
+            yield self.canvas